@@ -0,0 +1,34 @@
+"""
+Micro-benchmarks of the training and evaluation hot paths, run from the repository root, e.g.
+    python -m benchmarks.attr_head --device cuda
+"""
+import time
+
+import torch
+
+
+def benchmark(fn, device, warmup=3, iters=20):
+    """ Mean wall time of fn() in milliseconds, and the peak CUDA memory it allocated in MiB """
+    device = torch.device(device)
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - start) / iters * 1000
+    peak = 0.
+    if device.type == 'cuda':
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20
+    return elapsed, peak
+
+
+def print_table(header, rows):
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    for r in [header] + rows:
+        print('  '.join(str(v).rjust(w) for v, w in zip(r, widths)))
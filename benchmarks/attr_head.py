@@ -0,0 +1,50 @@
+"""
+Dense attribute classifier against SampledLinear, forward and backward of the
+binary cross entropy over the attribute vocabulary.
+    python -m benchmarks.attr_head --device cuda --num_attrs 66000
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks import benchmark, print_table
+from models.detr import SampledLinear
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.randn(args.num_rows, args.hidden_dim, device=device)
+    labels = torch.zeros(args.num_rows, args.num_attrs, device=device)
+    # a few positive attributes per object, drawn with a long tail
+    freq = torch.arange(1, args.num_attrs + 1, dtype=torch.float, device=device).pow(-1.)
+    pos = torch.multinomial(freq, args.num_rows * args.pos_per_row, replacement=True)
+    labels[torch.arange(args.num_rows, device=device).repeat_interleave(args.pos_per_row), pos] = 1
+
+    rows = []
+    for num_samples in [0] + args.num_samples:
+        head = SampledLinear(args.hidden_dim, args.num_attrs, num_samples=num_samples).to(device)
+        head.set_frequency(torch.bincount(pos, minlength=args.num_attrs))
+
+        def step():
+            classes = head.sample_classes(labels) if head.num_samples > 0 else None
+            logits = head(x, classes)
+            target = labels if classes is None else labels[:, classes]
+            F.binary_cross_entropy_with_logits(logits, target).backward()
+
+        ms, mem = benchmark(step, device, iters=args.iters)
+        rows.append(['dense' if num_samples == 0 else num_samples, '{:.2f}'.format(ms), '{:.1f}'.format(mem)])
+    print_table(['negatives', 'ms/step', 'peak MiB'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Attribute head benchmark')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--num_attrs', default=66000, type=int)
+    parser.add_argument('--hidden_dim', default=256, type=int)
+    parser.add_argument('--num_rows', default=512, type=int, help='objects with attribute targets in a batch')
+    parser.add_argument('--pos_per_row', default=3, type=int, help='positive attributes of an object')
+    parser.add_argument('--num_samples', default=[1024, 4096, 16384], type=int, nargs='+')
+    parser.add_argument('--iters', default=20, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,52 @@
+"""
+IoU and GIoU of N matched box pairs: the diagonal of the N x N pairwise matrices
+against the elementwise paired versions.
+    python -m benchmarks.box_iou --device cuda --sizes 1000 5000 10000 50000
+"""
+import argparse
+
+import torch
+
+from benchmarks import benchmark, print_table
+from util.box_ops import box_iou, generalized_box_iou, paired_box_iou, paired_generalized_box_iou
+from util.misc import IoU_values, paired_IoU_values
+
+PAIRS = [
+    ('iou', lambda a, b: box_iou(a, b)[0].diag(), lambda a, b: paired_box_iou(a, b)[0]),
+    ('giou', lambda a, b: generalized_box_iou(a, b).diag(), paired_generalized_box_iou),
+    ('IoU_values', lambda a, b: IoU_values(a, b).diag(), paired_IoU_values),
+]
+
+
+def _run(fn, a, b, device, iters):
+    try:
+        ms, mem = benchmark(lambda: fn(a, b), device, warmup=1, iters=iters)
+    except RuntimeError as e:
+        # the pairwise matrices of the large sizes do not fit in memory
+        if 'out of memory' not in str(e) and "can't allocate memory" not in str(e):
+            raise
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return 'OOM', '-'
+    return '{:.3f}'.format(ms), '{:.1f}'.format(mem)
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    rows = []
+    for n in args.sizes:
+        xy = torch.rand(n, 2, device=device) * 100
+        a = torch.cat([xy, xy + torch.rand(n, 2, device=device) * 50], 1)
+        b = a + torch.rand(n, 4, device=device) * 5
+        for name, pairwise, paired in PAIRS:
+            rows.append([n, name, *_run(pairwise, a, b, device, args.iters), *_run(paired, a, b, device, args.iters)])
+    print_table(['N', 'op', 'diag ms', 'diag MiB', 'paired ms', 'paired MiB'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Paired box IoU benchmark')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--sizes', default=[1000, 5000, 10000, 20000, 50000], type=int, nargs='+')
+    parser.add_argument('--iters', default=10, type=int)
+    main(parser.parse_args())
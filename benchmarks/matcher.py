@@ -0,0 +1,44 @@
+"""
+Hungarian matching of every decoder layer: one forward call per layer against a
+single match_layers call, serial and with a thread pool.
+    python -m benchmarks.matcher --device cuda --batch_size 32 --num_queries 100
+"""
+import argparse
+
+import torch
+
+from benchmarks import benchmark, print_table
+from models.matcher import HungarianMatcher
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    bs, nq = args.batch_size, args.num_queries
+    layer_outputs = [{'pred_logits': torch.randn(bs, nq, 2, device=device),
+                      'pred_boxes': torch.rand(bs, nq, 4, device=device) * 0.5 + 0.25}
+                     for _ in range(args.num_layers)]
+    targets = {'labels': torch.zeros(bs, 1, dtype=torch.long, device=device),
+               'boxes': torch.rand(bs, 4, device=device) * 0.5 + 0.25}
+
+    rows = []
+    serial = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2)
+    ms, _ = benchmark(lambda: [serial(o, targets) for o in layer_outputs], device, iters=args.iters)
+    rows.append(['per layer', 0, '{:.2f}'.format(ms), '{:.0f}'.format(bs * args.num_layers / ms * 1000)])
+    for num_workers in args.num_workers:
+        matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_workers=num_workers)
+        ms, _ = benchmark(lambda: matcher.match_layers(layer_outputs, targets), device, iters=args.iters)
+        rows.append(['match_layers', num_workers, '{:.2f}'.format(ms),
+                     '{:.0f}'.format(bs * args.num_layers / ms * 1000)])
+    print_table(['mode', 'workers', 'ms/batch', 'problems/s'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Matcher benchmark')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--num_queries', default=100, type=int)
+    parser.add_argument('--num_layers', default=6, type=int)
+    parser.add_argument('--num_workers', default=[0, 4, 8], type=int, nargs='+')
+    parser.add_argument('--iters', default=20, type=int)
+    main(parser.parse_args())
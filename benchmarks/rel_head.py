@@ -0,0 +1,52 @@
+"""
+Dense relation classifier against AdaptiveRelHead, forward and backward of the
+predicate loss over the relation vocabulary, for every decoder layer.
+    python -m benchmarks.rel_head --device cuda --num_rels 40000
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks import benchmark, print_table
+from models.detr import MLP, AdaptiveRelHead
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    input_dim = args.hidden_dim * 2
+    x = torch.randn(args.num_layers, args.num_pairs, input_dim, device=device)
+    # predicates follow a long tail, the adaptive head puts the frequent ones in its head cluster
+    freq = torch.arange(1, args.num_rels + 1, dtype=torch.float, device=device).pow(-1.)
+    labels = torch.multinomial(freq, args.num_pairs, replacement=True)
+
+    dense = MLP(input_dim, input_dim, args.num_rels, 3).to(device)
+    adaptive = AdaptiveRelHead(input_dim, input_dim, args.num_rels, args.cutoffs, 3).to(device)
+    adaptive.set_frequency(torch.bincount(labels, minlength=args.num_rels))
+
+    def dense_step():
+        logits = dense(x)
+        F.cross_entropy(logits.flatten(0, 1), labels.repeat(args.num_layers)).backward()
+
+    def adaptive_step():
+        log_prob, _ = adaptive(x, labels)
+        (-log_prob.mean()).backward()
+
+    rows = []
+    for name, step in [('dense', dense_step), ('adaptive', adaptive_step)]:
+        ms, mem = benchmark(step, device, iters=args.iters)
+        rows.append([name, '{:.2f}'.format(ms), '{:.1f}'.format(mem)])
+    print_table(['head', 'ms/step', 'peak MiB'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Relation head benchmark')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--num_rels', default=40000, type=int)
+    parser.add_argument('--hidden_dim', default=256, type=int)
+    parser.add_argument('--num_layers', default=6, type=int, help='decoder layers scored')
+    parser.add_argument('--num_pairs', default=256, type=int, help='relation pairs in a batch')
+    parser.add_argument('--cutoffs', default=None, type=int, nargs='+')
+    parser.add_argument('--iters', default=20, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,154 @@
+"""
+Grounding evaluator that works in distributed mode.
+
+Scores matched (predicted, ground truth) box pairs: accuracy at several IoU
+thresholds, mean IoU, and the same metrics per ground truth box size bucket.
+Only per-bucket sums and counts are kept, so the memory does not depend on
+the number of samples, and evaluators merge by adding them up.
+
+Standalone usage, scoring the prediction file written by evaluate (--pred_file)
+against the annotation file of the split:
+    python -m datasets.grounding_eval predictions.jsonl ./data/vg/val.json
+"""
+import argparse
+import json
+
+import torch
+import torch.distributed as dist
+
+from util.misc import is_dist_avail_and_initialized, paired_IoU_values
+
+# COCO small / medium / large box areas, in pixels
+SIZE_BUCKETS = (32 ** 2, 96 ** 2)
+SIZE_NAMES = ('small', 'medium', 'large')
+
+
+class GroundingEvaluator(object):
+    def __init__(self, iou_thresholds=(0.5, 0.75, 0.9), size_buckets=SIZE_BUCKETS, size_names=SIZE_NAMES,
+                 device=None):
+        assert len(size_names) == len(size_buckets) + 1
+        self.iou_thresholds = torch.as_tensor(iou_thresholds, dtype=torch.float, device=device)
+        self.size_buckets = torch.as_tensor(size_buckets, dtype=torch.float, device=device)
+        self.size_names = size_names
+        num_buckets = len(size_names)
+        # per size bucket: number of boxes, IoU sum and number of boxes above each threshold
+        self.count = torch.zeros(num_buckets, dtype=torch.float64, device=device)
+        self.iou_sum = torch.zeros(num_buckets, dtype=torch.float64, device=device)
+        self.correct = torch.zeros(len(iou_thresholds), num_buckets, dtype=torch.float64, device=device)
+
+    def to(self, device):
+        for k in ['iou_thresholds', 'size_buckets', 'count', 'iou_sum', 'correct']:
+            setattr(self, k, getattr(self, k).to(device))
+        return self
+
+    def update(self, pred_boxes, gt_boxes, ious=None):
+        """ pred_boxes, gt_boxes: N x 4 matched pairs, x0 y0 x1 y1 in pixels
+        ious: their IoUs when already computed, with paired_IoU_values as the criterion does
+        """
+        if self.count.device != pred_boxes.device:
+            self.to(pred_boxes.device)
+        if ious is None:
+            ious = paired_IoU_values(pred_boxes.float(), gt_boxes.float())
+        ious = torch.nan_to_num(ious, nan=0.)
+        areas = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+        buckets = torch.bucketize(areas.float(), self.size_buckets)
+        num_buckets = len(self.size_names)
+        self.count += torch.bincount(buckets, minlength=num_buckets)
+        self.iou_sum.index_add_(0, buckets, ious.double())
+        hits = (ious[None] >= self.iou_thresholds[:, None]).double()  # T x N
+        self.correct.index_add_(1, buckets, hits)
+        return ious
+
+    def merge(self, other):
+        self.count += other.count.to(self.count.device)
+        self.iou_sum += other.iou_sum.to(self.count.device)
+        self.correct += other.correct.to(self.count.device)
+
+    def synchronize_between_processes(self):
+        if not is_dist_avail_and_initialized():
+            return
+        t = torch.cat([self.count, self.iou_sum, self.correct.flatten()]).cuda()
+        dist.all_reduce(t)
+        t = t.to(self.count.device)
+        num_buckets = len(self.size_names)
+        self.count = t[:num_buckets]
+        self.iou_sum = t[num_buckets:2 * num_buckets]
+        self.correct = t[2 * num_buckets:].view(-1, num_buckets)
+
+    def summarize(self):
+        """ Returns the metrics as a dict, over all boxes and per size bucket """
+        count, iou_sum, correct = self.count.cpu(), self.iou_sum.cpu(), self.correct.cpu()
+        thresholds = self.iou_thresholds.tolist()
+
+        def _metrics(n, s, c):
+            n = max(n, 1)
+            out = {'Acc@{:g}'.format(t): c[i] / n for i, t in enumerate(thresholds)}
+            out['mIoU'] = s / n
+            return out
+
+        stats = _metrics(count.sum().item(), iou_sum.sum().item(), correct.sum(1).tolist())
+        stats['count'] = int(count.sum().item())
+        for b, name in enumerate(self.size_names):
+            for k, v in _metrics(count[b].item(), iou_sum[b].item(), correct[:, b].tolist()).items():
+                stats['{}_{}'.format(k, name)] = v
+            stats['count_{}'.format(name)] = int(count[b].item())
+        return stats
+
+    def print_summary(self):
+        stats = self.summarize()
+        keys = ['Acc@{:g}'.format(t) for t in self.iou_thresholds.tolist()] + ['mIoU']
+        print('{:>8}'.format('') + ''.join('{:>10}'.format(k) for k in keys + ['count']))
+        for name in ('',) + tuple(self.size_names):
+            suffix = '_' + name if name else ''
+            row = ['{:10.4f}'.format(stats[k + suffix]) for k in keys]
+            row.append('{:10d}'.format(stats['count' + suffix]))
+            print('{:>8}'.format(name or 'all') + ''.join(row))
+        return stats
+
+
+def load_gt_boxes(ann_file):
+    """ Ground truth boxes of an annotation file in the VGDataset format,
+    as {(region idx, word idx): [x0, y0, x1, y1]}, region idx following VGDataset
+    """
+    with open(ann_file, 'r') as f:
+        raw_data = json.load(f)
+    regions = []
+    for i in raw_data:
+        regions.extend(i['regions'])
+    gt = {}
+    for idx, region in enumerate(regions):
+        for obj in region['objects']:
+            gt[(idx, obj['idx'])] = [obj['x'], obj['y'], obj['x'] + obj['w'], obj['y'] + obj['h']]
+    return gt
+
+
+def evaluate_file(pred_file, ann_file, iou_thresholds=(0.5, 0.75, 0.9)):
+    """ Scores the JSONL predictions of PredictionWriter against the annotation file """
+    gt = load_gt_boxes(ann_file)
+    pred_boxes, gt_boxes = [], []
+    missing = 0
+    with open(pred_file, 'r') as f:
+        for line in f:
+            pred = json.loads(line)
+            key = (pred['idx'], pred['tgt_token'])
+            if key not in gt:
+                missing += 1
+                continue
+            pred_boxes.append(pred['box'])
+            gt_boxes.append(gt[key])
+    if missing:
+        print('{} predictions without a ground truth box'.format(missing))
+    evaluator = GroundingEvaluator(iou_thresholds)
+    evaluator.update(torch.tensor(pred_boxes, dtype=torch.float).view(-1, 4),
+                     torch.tensor(gt_boxes, dtype=torch.float).view(-1, 4))
+    return evaluator.print_summary()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Grounding evaluation of a prediction file')
+    parser.add_argument('pred_file', help='JSONL predictions written by evaluate with --pred_file')
+    parser.add_argument('ann_file', help='annotation file of the evaluated split')
+    parser.add_argument('--iou_thresholds', default='0.5,0.75,0.9', type=str)
+    args = parser.parse_args()
+    evaluate_file(args.pred_file, args.ann_file,
+                  tuple(float(t) for t in args.iou_thresholds.split(',')))
@@ -1,4 +1,4 @@
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, ConcatDataset
 from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import functional as F
 import torchvision.transforms as T
@@ -19,12 +19,25 @@ import spacy
 import math
 import os.path as osp
 import random
+from functools import lru_cache
 from util.data_utils import generate_iou_groundtruth, pad_object_maps, visual_sample
 from util.misc import nested_tensor_from_tensor_list, tlbr2cthw
 # from extended_config import cfg as conf
 
 
 nlp = spacy.load('en_core_web_lg')
+NOUN_TAGS = ('NOUN', 'PROPN', 'PRON')
+
+
+def load_image(img_file):
+    return PIL.Image.open(img_file).convert('RGB')
+
+
+def parse_text(text):
+    """ Word vectors (n x 300 float32) and part of speech tags of the words of text """
+    doc = nlp(text)
+    return np.array([q.vector for q in doc], dtype=np.float32), tuple(q.pos_ for q in doc)
+
 
 class NewDistributedSampler(DistributedSampler):
     """
@@ -58,6 +71,63 @@ class NewDistributedSampler(DistributedSampler):
         return iter(indices)
 
 
+class SkipBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that skips the first `skip` batches of one epoch, to resume that
+    epoch from a step checkpoint, see skip_batches. The skipped indices are drawn from
+    the wrapped sampler, to keep its order, but their samples are never loaded.
+    The length is the number of batches left in the current epoch, it only changes
+    with set_epoch.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.epoch = 0
+        self.skip_epoch = None
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        """ Sets the epoch of the wrapped sampler too, e.g. a DistributedSampler """
+        self.epoch = epoch
+        if hasattr(self.batch_sampler.sampler, 'set_epoch'):
+            self.batch_sampler.sampler.set_epoch(epoch)
+
+    def skip_batches(self, epoch, skip):
+        self.skip_epoch = epoch
+        self.skip = skip
+
+    def _num_skipped(self):
+        return self.skip if self.epoch == self.skip_epoch else 0
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        for _ in range(self._num_skipped()):
+            next(batches, None)
+        yield from batches
+
+    def __len__(self):
+        return len(self.batch_sampler) - self._num_skipped()
+
+
+class UnpaddedDistributedSampler(DistributedSampler):
+    """
+    Sequential distributed sampler for evaluation
+    Shards the dataset without the padding of the default sampler, so every
+    sample is evaluated exactly once. Ranks may get one sample less than others,
+    so the evaluation loop must not run per-batch collectives.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        self.num_samples = len(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return self.num_samples
+
+
 class VGDataset(Dataset):
     """
     Any Grounding dataset.
@@ -75,6 +145,8 @@ class VGDataset(Dataset):
         self.is_train = (self.split_type == 'train')
         self.use_mlm = cfg.use_mlm
         self.use_obj_att = not cfg.no_obj_att
+        self.num_attrs = cfg.num_attrs
+        self.num_rels = cfg.num_rels
         # self.image_data = pd.read_csv(csv_file)
         self.image_data = self._read_annotations(json_file)
         # self.image_data = self.image_data.iloc[:200]
@@ -86,6 +158,35 @@ class VGDataset(Dataset):
             T.ToTensor(),
             T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
+        self.image_cache_size = 0
+        self.text_cache_size = 0
+        self._caches = None
+
+    def set_cache_sizes(self, image_cache_size, text_cache_size):
+        """ LRU caches of the decoded images and of the parsed expressions, one per loader
+        worker. Only worth it for a sequential order, e.g. the evaluation splits, where
+        consecutive regions share their image: the random train order hits nothing.
+        """
+        self.image_cache_size = image_cache_size
+        self.text_cache_size = text_cache_size
+        self._caches = None
+
+    def __getstate__(self):
+        # the caches are built in each worker
+        state = self.__dict__.copy()
+        state['_caches'] = None
+        return state
+
+    def _load(self, img_file, text):
+        if self._caches is None:
+            self._caches = (lru_cache(maxsize=self.image_cache_size)(load_image),
+                            lru_cache(maxsize=self.text_cache_size)(parse_text))
+        load_image_cached, parse_text_cached = self._caches
+        img = load_image_cached(img_file)
+        if self.image_cache_size > 0:
+            # the cached image is shared by the later calls
+            img = img.copy()
+        return img, parse_text_cached(text)
 
     def __len__(self):
         return len(self.image_data)
@@ -133,7 +234,7 @@ class VGDataset(Dataset):
         return att_maps
 
     def get_attr_labels(self, qlen, annot):
-        attr_labels = np.zeros((len(annot['attributes']), 66000))
+        attr_labels = np.zeros((len(annot['attributes']), self.num_attrs))
         # print(annot)
         attr_ids = []
         for i, a in enumerate(annot['attributes']):
@@ -143,6 +244,22 @@ class VGDataset(Dataset):
             attr_ids.append(a['sent_idx'])
         return attr_labels[:len(attr_ids)], attr_ids
     
+    def attr_frequency(self):
+        """ Number of annotated words of each attribute category """
+        counts = np.zeros(self.num_attrs)
+        for annot in self.image_data:
+            for a in annot['attributes']:
+                counts[a['attr_ids']] += 1
+        return torch.from_numpy(counts).float()
+
+    def rel_frequency(self):
+        """ Number of annotated relationships of each predicate category """
+        counts = np.zeros(self.num_rels)
+        for annot in self.image_data:
+            for r in annot['relationships']:
+                counts[r['rel_idx']] += 1
+        return torch.from_numpy(counts).float()
+
     def get_rel_ids(self, qlen, annot):
         obj_ids = []
         sub_ids = []
@@ -157,23 +274,22 @@ class VGDataset(Dataset):
 
     def simple_item_getter(self, idx):
         img_file, annot, q_chosen = self.load_annotations(idx)
-        img = PIL.Image.open(img_file).convert('RGB')
-        h, w = img.height, img.width
-        
-        # img_ = np.array(img)
         q_chosen = q_chosen.strip()
         sents = q_chosen
         q_chosen = 'ANS ' + q_chosen
-        qtmp = nlp(str(q_chosen))
+        img, (word_vectors, word_tags) = self._load(img_file, str(q_chosen))
+        h, w = img.height, img.width
 
-        qlen = min(len(qtmp), self.phrase_len)
-        q_chosen_emb = qtmp[:qlen]
+        # img_ = np.array(img)
+        qlen = min(len(word_tags), self.phrase_len)
         bboxs, labels = self.get_bboxs(qlen, annot, h, w)
         if len(labels) == sum(labels):
             return self.simple_item_getter(idx + 1)
         if self.use_obj_att:
             obj_maps = self.get_object_maps(qlen, annot, h, w)
-        q_chosen_emb_vecs = np.array([q.vector for q in q_chosen_emb])
+        q_chosen_emb_vecs = np.array(word_vectors[:qlen])
+        # Words that can ground an object, used as decoding candidates at inference
+        nouns = [int(tag in NOUN_TAGS) for tag in word_tags[:qlen]]
         # Add attributes
         attr_labels, attr_ids = self.get_attr_labels(qlen, annot)
         # qlen = len(q_chosen_emb_vecs)
@@ -184,10 +300,12 @@ class VGDataset(Dataset):
         out = {
             'img': img,
             'idxs': torch.tensor(idx).long(),
+            'image_id': torch.tensor(annot['image_id']).long(),
             'qvec': torch.from_numpy(q_chosen_emb_vecs).float(),
             'qlens': torch.tensor(qlen),
             'cthw': torch.tensor(bboxs).float(),
             'labels': torch.tensor(labels, dtype=torch.long).unsqueeze(-1),  # 0 reps object and 1 reps no-object
+            'noun_labels': torch.tensor(nouns, dtype=torch.long).unsqueeze(-1),  # 1 reps noun
             'attr_labels': torch.tensor(attr_labels).float(),
             'orig_size': torch.tensor([h, w]),
             'size': torch.tensor([h, w]),
@@ -217,13 +335,52 @@ class VGDataset(Dataset):
         return data
 
 
+class MultiSplitDataset(ConcatDataset):
+    """
+    Several evaluation splits behind one loader, so they share one model load
+    and one pool of loader workers, which cache the images and expressions of the
+    splits, see VGDataset.set_cache_sizes.
+    Each sample gets the 'split_id' of its split in split_names.
+    """
+
+    def __init__(self, splits, image_cache_size=32, text_cache_size=4096):
+        self.split_names = list(splits.keys())
+        super().__init__(list(splits.values()))
+        for ds in self.datasets:
+            ds.set_cache_sizes(image_cache_size, text_cache_size)
+
+    def __getitem__(self, idx):
+        out = super().__getitem__(idx)
+        out['split_id'] = torch.tensor(self.split_of(idx))
+        return out
+
+    def split_of(self, idx):
+        return int(np.searchsorted(self.cumulative_sizes, idx, side='right'))
+
+
+def eval_split_names(ds_info):
+    """ Evaluation splits of a dataset entry of ds_info, e.g. val_csv_file -> 'val',
+    test_csv_fileA -> 'testA'
+    """
+    return {key.replace('_csv_file', ''): key for key in ds_info
+            if key.startswith(('val', 'test')) and '_csv_file' in key}
+
+
+def load_num_categories(filename, default):
+    """ Size of a category vocabulary written by preprocess_vg.py, e.g. attr_categories.json """
+    if filename is None:
+        return default
+    with open(filename, 'r') as f:
+        return len(json.load(f))
+
+
 def collater(batch):
     # qlens = torch.Tensor([i['qlens'] for i in batch])
     # max_qlen = int(qlens.max().item())
     # query_vecs = [torch.Tensor(i['query'][:max_qlen]) for i in batch]
     out_dict = {}
     for k in batch[0]:
-        if k in ['sents', 'img', 'qvec', 'text_labels', 'masked_words', 'labels', \
+        if k in ['sents', 'img', 'qvec', 'text_labels', 'masked_words', 'labels', 'noun_labels', \
             'obj_maps', 'cthw', 'attr_labels', 'attr_ids', 'obj_ids', 'sub_ids', 'rel_labels']:
             out_dict[k] = [b[k] for b in batch]
         else:
@@ -235,6 +392,8 @@ def collater(batch):
     if 'labels' in batch[0].keys():
         # batch * T * 1
         out_dict['labels'] = nested_tensor_from_tensor_list(out_dict['labels'])
+    if 'noun_labels' in batch[0].keys():
+        out_dict['noun_labels'] = nested_tensor_from_tensor_list(out_dict['noun_labels'])
     # if 'attr_labels' in batch[0].keys():
     #     out_dict['attr_labels'] = nested_tensor_from_tensor_list(out_dict['attr_labels'])
     if 'cthw' in batch[0].keys():
@@ -283,6 +442,10 @@ def get_data(cfg, ds_info):
         val_ds = VGDataset(cfg=cfg, json_file=val_csv_file,
                             ds_name=ds_name, split_type='valid')
         test_ds = {'test': val_ds}
+        if getattr(cfg, 'eval_splits', False):
+            test_ds = {name: val_ds if key == 'val_csv_file' else
+                       VGDataset(cfg=cfg, json_file=ds_info[ds_name][key], ds_name=ds_name, split_type='valid')
+                       for name, key in eval_split_names(ds_info[ds_name]).items()}
 
     return {
         "train": trn_ds,
@@ -291,8 +454,13 @@ def get_data(cfg, ds_info):
     }
 
 
-def make_data_sampler(dataset, shuffle, distributed):
+def make_data_sampler(dataset, shuffle, distributed, pad=True):
+    """ pad: pad the distributed shards to equal sizes, evaluation samplers should not,
+    see UnpaddedDistributedSampler
+    """
     if distributed:
+        if not pad:
+            return UnpaddedDistributedSampler(dataset)
         return NewDistributedSampler(dataset, shuffle=shuffle)
     if shuffle:
         sampler = torch.utils.data.sampler.RandomSampler(dataset)
@@ -1,6 +1,7 @@
 """
 Train and eval functions used in main.py
 """
+import json
 import math
 import os
 import sys
@@ -11,79 +12,171 @@ import pandas as pd
 import torch
 
 import util.misc as utils
-from util.visualize import save_visualize
+from util.visualize import AttentionDumper
+from util.prediction_writer import PredictionWriter
+from util.prefetcher import DevicePrefetcher
+from datasets.grounding_eval import GroundingEvaluator
 from datasets.coco_eval import CocoEvaluator
 from datasets.panoptic_eval import PanopticEvaluator
-from models import detr
 
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0):
+                    device: torch.device, epoch: int, max_norm: float = 0,
+                    start_step: int = 0, logger_state=None, iou_meter_state=None, step_callbacks=(),
+                    deferred_logging=False):
+    """ start_step, logger_state, iou_meter_state: position, MetricLogger and IoUMeter states when
+    resuming a step checkpoint, data_loader already starts at start_step.
+    step_callbacks: (every, fn) pairs, fn(step, metric_logger) is called every `every` steps,
+    e.g. to save a step checkpoint or run a subset evaluation.
+    deferred_logging: keep the step losses on the device, they are reduced over the processes
+    and copied to the host once every print_freq steps, see MetricLogger.update_deferred.
+    """
     model.train()
     criterion.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    if logger_state is not None:
+        metric_logger.load_state_dict(logger_state)
     # metric_logger.add_meter('class_error', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    if iou_meter_state is not None:
+        criterion.iou_meter.load_state_dict(iou_meter_state)
+    else:
+        criterion.iou_meter.reset()
     if model.module.bert_type is None:
         lang_key = 'qvec'
     else:
         lang_key = 'sents'
-    for targets in metric_logger.log_every(data_loader, print_freq, header):
-        targets = {k: v.to(device) if k not in ['sents', 'masked_words'] else v for k, v in targets.items()}
+    # the batches arrive on the device, copied while the previous step runs
+    prefetcher = DevicePrefetcher(data_loader, device)
+    # deferred logging: device flag, false from the first non-finite loss or gradient on
+    finite = None
+    for step, targets in enumerate(metric_logger.log_every(prefetcher, print_freq, header), start_step):
         samples = targets['img'] if 'img' in targets.keys() else None
         outputs = model(samples, targets[lang_key], targets)
         loss_dict = criterion(outputs, targets)
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                    for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
+        if deferred_logging:
+            # no host sync in the step, the values are read every print_freq steps, before
+            # log_every prints them and before a callback reads the logger
+            loss_dict_scaled = {k: v * weight_dict[k] for k, v in loss_dict.items() if k in weight_dict}
+            loss_dict_unscaled = {f'{k}_unscaled': v for k, v in loss_dict.items()}
+            metric_logger.update_deferred(loss=sum(loss_dict_scaled.values()),
+                                          **loss_dict_scaled, **loss_dict_unscaled)
+            if finite is None:
+                finite = torch.ones((), dtype=torch.bool, device=losses.device)
+            i = step - start_step
+            if i % print_freq == 0 or i == len(prefetcher) - 1 or \
+                    any(every > 0 and (step + 1) % every == 0 for every, _ in step_callbacks):
+                for row in metric_logger.flush_deferred():
+                    if not math.isfinite(row['loss']):
+                        print("Loss is {}, stopping training".format(row['loss']))
+                        print(row)
+                        sys.exit(1)
+            # the non-finite losses are only seen by the host at the next flush, the steps
+            # until then are zeroed on the device
+            finite = _train_step(model, optimizer, losses, max_norm, finite)
+        else:
+            # reduce losses over all GPUs for logging purposes
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
+            loss_dict_reduced_unscaled = {f'{k}_unscaled': v
+                                          for k, v in loss_dict_reduced.items()}
+            loss_dict_reduced_scaled = {k: v * weight_dict[k]
+                                        for k, v in loss_dict_reduced.items() if k in weight_dict}
+            losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
 
-        loss_value = losses_reduced_scaled.item()
+            loss_value = losses_reduced_scaled.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict_reduced)
+                sys.exit(1)
 
-        optimizer.zero_grad()
-        losses.backward()
-        if max_norm > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        optimizer.step()
+            _train_step(model, optimizer, losses, max_norm)
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
+            metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
         # metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-        del targets, samples, outputs, loss_dict, weight_dict, loss_dict_reduced, loss_dict_reduced_unscaled,\
-            loss_dict_reduced_scaled, loss_value, losses
+        for every, fn in step_callbacks:
+            if every > 0 and (step + 1) % every == 0:
+                fn(step + 1, metric_logger)
+                # the callback may have evaluated
+                model.train()
+                criterion.train()
+        del targets, samples, outputs, loss_dict, weight_dict, losses
         # torch.cuda.empty_cache()
         # targets = {k: v.to('cpu') if k not in ['sents', 'masked_words'] else v for k, v in targets.items()}
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
+    criterion.iou_meter.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats.update(criterion.iou_meter.summary())
+    stats['prefetch_hidden_time'] = prefetcher.hidden_time
+    stats['prefetch_copy_time'] = prefetcher.copy_time
+    print("Host to device copies: {:.2f}s, hidden by prefetching: {:.2f}s".format(
+        prefetcher.copy_time, prefetcher.hidden_time))
+    return stats
+
+
+def _train_step(model, optimizer, losses, max_norm, finite=None):
+    """ finite: device flag of the deferred logging, the gradients are zeroed, without a host
+    sync, once a loss or a gradient norm was non-finite. Returns the updated flag.
+    """
+    optimizer.zero_grad()
+    losses.backward()
+    if finite is None:
+        if max_norm > 0:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+        optimizer.step()
+        return None
+    # the gradients are reduced over the processes, so their norm is non-finite on every
+    # process as soon as the loss of one is
+    grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm if max_norm > 0 else float('inf'))
+    finite = finite & torch.isfinite(losses.detach()) & torch.isfinite(grad_norm)
+    for p in model.parameters():
+        if p.grad is not None:
+            p.grad.masked_fill_(~finite, 0.)
+    optimizer.step()
+    return finite
 
 
 @torch.no_grad()
-def evaluate(model, criterion, postprocessors, data_loader, device, output_dir, visualize_dir=None):
+def evaluate(model, criterion, postprocessors, data_loader, device, output_dir, visualize_dir=None,
+             eval_mode='full', pred_file=None, visualize_rate=1.0, visualize_ids=None,
+             iou_thresholds=(0.5, 0.75, 0.9)):
+    """ pred_file: optional JSONL file in output_dir, where the matched prediction of every
+    sample is written, see PredictionWriter
+    visualize_rate, visualize_ids: the samples whose attention maps are saved to visualize_dir,
+    see AttentionDumper
+    iou_thresholds: accuracy thresholds of the GroundingEvaluator, reported in stats['grounding'],
+    the threshold of the criterion accuracy is always added
+    """
+    if eval_mode == 'fast' and visualize_dir is None:
+        return evaluate_fast(model, criterion, data_loader, device, output_dir, pred_file, iou_thresholds)
+    # The val shards are unequal (see UnpaddedDistributedSampler), so the evaluation runs
+    # on the unwrapped model and without per-batch collectives, the metrics are reduced
+    # as sums and counts at the end
+    model = getattr(model, 'module', model)
     model.eval()
     criterion.eval()
-    if model.module.bert_type is None:
+    if model.bert_type is None:
         lang_key = 'qvec'
     else:
         lang_key = 'sents'
     metric_logger = utils.MetricLogger(delimiter="  ")
 #    metric_logger.add_meter('class_error', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Test:'
+    criterion.iou_meter.reset()
+    writer = PredictionWriter(os.path.join(output_dir, pred_file)) if pred_file else None
+    grounding_evaluator = GroundingEvaluator(_with_acc_threshold(iou_thresholds, criterion), device=device)
+    dumper = None
+    if visualize_dir is not None:
+        dumper = AttentionDumper(visualize_dir, visualize_rate, visualize_ids)
 
     # iou_types = tuple(k for k in ('segm', 'bbox') if k in postprocessors.keys())
     # coco_evaluator = CocoEvaluator(base_ds, iou_types)
@@ -97,41 +190,39 @@ def evaluate(model, criterion, postprocessors, data_loader, device, output_dir,
 #            output_dir=os.path.join(output_dir, "panoptic_eval"),
 #        )
 
-    for targets in metric_logger.log_every(data_loader, 10, header):
+    for targets in metric_logger.log_every(DevicePrefetcher(data_loader, device), 10, header):
         # print(targets['sents'])
         # targets = {k: v.to(device) if k not in ['sents'] else v for k, v in targets.items()}
-        targets = {k: v.to(device) if k not in ['sents', 'masked_words'] else v for k, v in targets.items()}
+        # the attention maps are only computed for batches with dumped samples
+        idxs = targets['idxs'].tolist() if dumper is not None else None
+        keep = dumper.select(idxs) if dumper is not None else []
         samples = targets['img'] if 'img' in targets.keys() else None
-        outputs = model(samples, targets[lang_key], targets, visualize=visualize_dir is not None)
-        if visualize_dir is not None and utils.is_main_process():
-            outputs['sents'] = targets['sents']
-            outputs['ids'] = targets['idxs'].tolist()
-            outputs['img'] = targets['img'].decompose()[0].cpu().tolist()
-            save_visualize(outputs, visualize_dir)
-        loss_dict = criterion(outputs, targets)
+        outputs = model(samples, targets[lang_key], targets, visualize=len(keep) > 0)
+        if keep:
+            dumper.put(outputs, targets, keep, idxs)
+        # the final layer matching of the losses is reused for the predictions
+        loss_dict, indices = criterion(outputs, targets, return_indices=True)
         weight_dict = criterion.weight_dict
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                      for k, v in loss_dict_reduced.items()}
-        metric_logger.update(loss=sum(loss_dict_reduced_scaled.values()),
-                             **loss_dict_reduced_scaled,
-                             **loss_dict_reduced_unscaled)
+        # local losses and accuracy are means over the matched words, weighted by their number
+        # in the global averages, which are then those of a single process
+        loss_dict_scaled = {k: v * weight_dict[k]
+                            for k, v in loss_dict.items() if k in weight_dict}
+        loss_dict_unscaled = {f'{k}_unscaled': v
+                              for k, v in loss_dict.items()}
+        metric_logger.update(n=len(indices.batch_idx),
+                             loss=sum(loss_dict_scaled.values()),
+                             **loss_dict_scaled,
+                             **loss_dict_unscaled)
+        preds = criterion.matched_predictions(outputs, targets, indices)
+        grounding_evaluator.update(preds['box'], preds['gt_box'], preds['iou'])
+        if writer is not None:
+            writer.put(preds)
 #        metric_logger.update(class_error=loss_dict_reduced['class_error'])
 
         # orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
         # orig_target_sizes = targets['orig_size']
         # results = postprocessors['bbox'](outputs, orig_target_sizes)
-    # save ious
-    iou_filename = os.path.join(output_dir, 'iou.pl')
-    with open(iou_filename, 'wb') as f:
-        pickle.dump({
-            'correct': detr.CORRECT_IOUS,
-            'wrong': detr.WRONG_IOUS
-        }, f)
 #        if 'segm' in postprocessors.keys():
 #            target_sizes = torch.stack([t["size"] for t in targets], dim=0)
 #            results = postprocessors['segm'](results, outputs, orig_target_sizes, target_sizes)
@@ -150,8 +241,18 @@ def evaluate(model, criterion, postprocessors, data_loader, device, output_dir,
 #            panoptic_evaluator.update(res_pano)
 
     # gather the stats from all processes
+    if writer is not None:
+        writer.close()
+    if dumper is not None:
+        dumper.close()
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
+    iou_stats = _iou_stats(criterion.iou_meter, grounding_evaluator)
+    # save the iou histogram
+    if utils.is_main_process():
+        iou_filename = os.path.join(output_dir, 'iou.pl')
+        with open(iou_filename, 'wb') as f:
+            pickle.dump(criterion.iou_meter.state_dict(), f)
 #    if coco_evaluator is not None:
 #        coco_evaluator.synchronize_between_processes()
 #    if panoptic_evaluator is not None:
@@ -165,6 +266,7 @@ def evaluate(model, criterion, postprocessors, data_loader, device, output_dir,
 #    if panoptic_evaluator is not None:
 #        panoptic_res = panoptic_evaluator.summarize()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats.update(iou_stats)
 #    if coco_evaluator is not None:
 #        if 'bbox' in postprocessors.keys():
 #            stats['coco_eval_bbox'] = coco_evaluator.coco_eval['bbox'].stats.tolist()
@@ -175,3 +277,106 @@ def evaluate(model, criterion, postprocessors, data_loader, device, output_dir,
 #        stats['PQ_th'] = panoptic_res["Things"]
 #        stats['PQ_st'] = panoptic_res["Stuff"]
     return stats
+
+
+@torch.inference_mode()
+def evaluate_fast(model, criterion, data_loader, device, output_dir, pred_file=None,
+                  iou_thresholds=(0.5, 0.75, 0.9)):
+    """ Grounding accuracy only: the model returns the final boxes, which are matched
+    to the targets and accumulated in criterion.iou_meter. No loss is computed.
+    """
+    model = getattr(model, 'module', model)
+    model.eval()
+    criterion.eval()
+    if model.bert_type is None:
+        lang_key = 'qvec'
+    else:
+        lang_key = 'sents'
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Test:'
+    criterion.iou_meter.reset()
+    writer = PredictionWriter(os.path.join(output_dir, pred_file)) if pred_file else None
+    grounding_evaluator = GroundingEvaluator(_with_acc_threshold(iou_thresholds, criterion), device=device)
+
+    for targets in metric_logger.log_every(DevicePrefetcher(data_loader, device), 10, header):
+        samples = targets['img'] if 'img' in targets.keys() else None
+        outputs = model(samples, targets[lang_key], targets, boxes_only=True)
+        preds = criterion.match_boxes(outputs, targets)
+        grounding_evaluator.update(preds['box'], preds['gt_box'], preds['iou'])
+        if writer is not None:
+            writer.put(preds)
+
+    if writer is not None:
+        writer.close()
+    stats = _iou_stats(criterion.iou_meter, grounding_evaluator)
+    if utils.is_main_process():
+        iou_filename = os.path.join(output_dir, 'iou.pl')
+        with open(iou_filename, 'wb') as f:
+            pickle.dump(criterion.iou_meter.state_dict(), f)
+    # same key as the accuracy of the full evaluation
+    stats['accuracy'] = stats['grounding']['Acc@{:g}'.format(criterion.acc_iou_threshold)]
+    return stats
+
+
+def _with_acc_threshold(iou_thresholds, criterion):
+    """ The thresholds of the GroundingEvaluator, with the one of the criterion accuracy """
+    if any('{:g}'.format(t) == '{:g}'.format(criterion.acc_iou_threshold) for t in iou_thresholds):
+        return tuple(iou_thresholds)
+    return tuple(sorted(tuple(iou_thresholds) + (criterion.acc_iou_threshold,)))
+
+
+def _iou_stats(iou_meter, grounding_evaluator):
+    """ Reduces the meter and the evaluator, which accumulate the same IoUs. The accuracies and
+    the mean IoU are reported once, by the evaluator under 'grounding', the meter adds the
+    IoU quantiles and the NaN count.
+    """
+    iou_meter.synchronize_between_processes()
+    grounding_evaluator.synchronize_between_processes()
+    grounding = grounding_evaluator.print_summary()
+    stats = {k: v for k, v in iou_meter.summary().items() if k not in grounding}
+    print("IoU stats:", stats)
+    stats['grounding'] = grounding
+    return stats
+
+
+@torch.inference_mode()
+def evaluate_splits(model, criterion, data_loader, device, output_dir, iou_thresholds=(0.5, 0.75, 0.9)):
+    """ Fast evaluation of every split of a MultiSplitDataset in one pass over data_loader,
+    with one GroundingEvaluator per split. Prints the combined table, returns {split: stats}.
+    """
+    model = getattr(model, 'module', model)
+    model.eval()
+    criterion.eval()
+    if model.bert_type is None:
+        lang_key = 'qvec'
+    else:
+        lang_key = 'sents'
+    split_names = data_loader.dataset.split_names
+    evaluators = [GroundingEvaluator(iou_thresholds, device=device) for _ in split_names]
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Test:'
+
+    for targets in metric_logger.log_every(DevicePrefetcher(data_loader, device), 10, header):
+        samples = targets['img'] if 'img' in targets.keys() else None
+        outputs = model(samples, targets[lang_key], targets, boxes_only=True)
+        indices = criterion.matcher(outputs, targets)
+        preds = criterion.matched_predictions(outputs, targets, indices)
+        split_ids = targets['split_id'][indices.batch_idx]
+        for i, evaluator in enumerate(evaluators):
+            in_split = split_ids == i
+            evaluator.update(preds['box'][in_split], preds['gt_box'][in_split], preds['iou'][in_split])
+
+    stats = {}
+    for name, evaluator in zip(split_names, evaluators):
+        evaluator.synchronize_between_processes()
+        stats[name] = evaluator.summarize()
+    # combined table, one row per split
+    keys = ['Acc@{:g}'.format(t) for t in iou_thresholds] + ['mIoU']
+    print('{:>10}'.format('split') + ''.join('{:>10}'.format(k) for k in keys + ['count']))
+    for name in split_names:
+        row = ''.join('{:10.4f}'.format(stats[name][k]) for k in keys)
+        print('{:>10}'.format(name) + row + '{:10d}'.format(stats[name]['count']))
+    if utils.is_main_process():
+        with open(os.path.join(output_dir, 'eval_splits.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+    return stats
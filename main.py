@@ -16,8 +16,11 @@ from yacs.config import CfgNode as CN
 
 import datasets
 import util.misc as utils
-from datasets.ref_data import get_data, collater
-from engine import evaluate, train_one_epoch
+from datasets.ref_data import (get_data, collater, load_num_categories, make_data_sampler,
+                               MultiSplitDataset, SkipBatchSampler)
+from engine import evaluate, evaluate_fast, evaluate_splits, train_one_epoch
+from util.checkpoint import CheckpointManager, slim_state_dict, load_checkpoint, load_model_state
+from util.eval_workers import EvaluatorPool
 from models import build_model
 
 # torch.autograd.set_detect_anomaly(True)
@@ -70,6 +73,8 @@ def get_args_parser():
     parser.add_argument('--pre_norm', action='store_true')
     parser.add_argument('--no_cross_encoder', action='store_true',
                         help="Whether to use cross modal encoder or not")
+    parser.add_argument('--candidate_heads', action='store_true',
+                        help="Apply the box and class heads to candidate words only: labeled objects in training, nouns at inference")
     
     # * Segmentation
     parser.add_argument('--masks', action='store_true',
@@ -78,6 +83,8 @@ def get_args_parser():
     # Loss
     parser.add_argument('--no_aux_loss', dest='aux_loss', action='store_false',
                         help="Disables auxiliary decoding losses (loss at each layer)")
+    parser.add_argument('--batched_aux_loss', action='store_true',
+                        help="Compute the auxiliary losses of all decoder layers together")
     parser.add_argument('--use_mlm', action='store_true',
                         help='Use mlm loss during training')
     # * Matcher
@@ -89,6 +96,8 @@ def get_args_parser():
                         help="L1 box coefficient in the matching cost")
     parser.add_argument('--set_cost_giou', default=2, type=float,
                         help="giou box coefficient in the matching cost")
+    parser.add_argument('--matcher_workers', default=0, type=int,
+                        help="Threads solving the hungarian assignments, 0 solves them serially")
     # * Loss coefficients
     # parser.add_argument('--mask_loss_coef', default=1, type=float)
     # parser.add_argument('--dice_loss_coef', default=1, type=float)
@@ -106,6 +115,12 @@ def get_args_parser():
                         help="Attributes prediction loss")
     parser.add_argument('--rel_loss_coef', default=1, type=float,
                         help='Relationships prediction loss')
+    parser.add_argument('--attr_neg_samples', default=0, type=int,
+                        help="Number of sampled negative attributes per batch, 0 scores all attributes")
+    parser.add_argument('--rel_head', default='mlp', type=str, choices=('mlp', 'adaptive'),
+                        help="Dense relation classifier or adaptive softmax over frequency clusters")
+    parser.add_argument('--rel_cutoffs', default=None, type=str,
+                        help="Comma separated cluster boundaries of the adaptive relation head")
     parser.add_argument('--no_img', action='store_true', default=False,
                         help='Not to use image during pretraining')
     parser.add_argument('--no_obj_att', action='store_true', default=False,
@@ -117,6 +132,10 @@ def get_args_parser():
                         help="For REC task")
     parser.add_argument("--ds_info", default="data/ds_info.json",
                         help="filename of data config")
+    parser.add_argument('--attr_categories', default=None, type=str,
+                        help="attr_categories.json written by preprocess_vg.py, sizes the attribute head")
+    parser.add_argument('--rel_categories', default=None, type=str,
+                        help="rel_categories.json written by preprocess_vg.py, sizes the relation head")
     # parser.add_argument('--coco_path', type=str)
     # parser.add_argument('--coco_panoptic_path', type=str)
     # parser.add_argument('--remove_difficult', action='store_true')
@@ -129,10 +148,51 @@ def get_args_parser():
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=42, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
+    parser.add_argument('--deferred_logging', action='store_true',
+                        help='keep the training losses on the device and reduce them once every print step')
+    parser.add_argument('--checkpoint_steps', default=0, type=int,
+                        help='also save a resumable checkpoint every N training steps, 0 disables')
+    parser.add_argument('--full_checkpoints', action='store_true',
+                        help='also save the frozen pretrained weights (bert, backbone) in the checkpoints')
+    parser.add_argument('--keep_last_checkpoints', default=5, type=int,
+                        help='number of the most recent per-epoch checkpoints kept')
+    parser.add_argument('--keep_best_checkpoints', default=1, type=int,
+                        help='number of the best per-epoch checkpoints kept, by --checkpoint_metric')
+    parser.add_argument('--checkpoint_metric', default='accuracy', type=str,
+                        help='test stat ranking the checkpoints, higher is better')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--eval', action='store_true')
+    parser.add_argument('--eval_mode', default='full', choices=['full', 'fast'],
+                        help="fast only computes the grounding accuracy/IoU, without the losses and "
+                             "the attribute, relation and object attention heads")
     parser.add_argument('--num_workers', default=2, type=int)
+    parser.add_argument('--eval_schedule', default='epoch', choices=['epoch', 'subset', 'process'],
+                        help="epoch: full evaluation after every epoch in the training processes; "
+                             "subset: fast evaluation of a fixed random val subset every --eval_steps steps; "
+                             "process: evaluation of every epoch checkpoint by --eval_workers separate processes. "
+                             "The last two run the full evaluation at the end of training")
+    parser.add_argument('--eval_steps', default=1000, type=int)
+    parser.add_argument('--eval_subset_size', default=1000, type=int)
+    parser.add_argument('--eval_workers', default=1, type=int)
+    parser.add_argument('--eval_device', default=None, type=str,
+                        help='only device of the evaluator processes, e.g. cuda:3 or cpu, '
+                             'the GPU of the first training process by default')
+    parser.add_argument('--eval_dir', default=None, type=str,
+                        help='with --eval, directory in output_dir of the evaluation files, '
+                             'which also gets the test stats in stats.json')
+    parser.add_argument('--eval_log_epoch', default=None, type=int,
+                        help='with --eval, append the test stats of this epoch to log.txt')
+    parser.add_argument('--eval_splits', action='store_true',
+                        help='with --eval, evaluate every val/test split of ds_info in one pass')
+    parser.add_argument('--image_cache_size', default=32, type=int,
+                        help='with --eval_splits, decoded images cached by each loader worker')
+    parser.add_argument('--text_cache_size', default=4096, type=int,
+                        help='with --eval_splits, parsed expressions cached by each loader worker')
+    parser.add_argument('--iou_thresholds', default='0.5,0.75,0.9', type=str,
+                        help='comma separated IoU thresholds of the evaluation accuracies')
+    parser.add_argument('--pred_file', default=None, type=str,
+                        help='JSONL file in output_dir where the evaluation writes the per-sample predictions')
 
     # distributed training parameters
     parser.add_argument('--world_size', default=1, type=int,
@@ -142,6 +202,10 @@ def get_args_parser():
     # attention visualization parameters
     parser.add_argument('--visualize_dir', default=None, type=str,
                         help='output directory of attention map, if None, there is not')
+    parser.add_argument('--visualize_rate', default=1.0, type=float,
+                        help='fraction of the samples whose attention maps are saved')
+    parser.add_argument('--visualize_ids', default=None, type=str,
+                        help='comma separated sample idxs whose attention maps are saved, overrides the rate')
     return parser
 
 
@@ -161,7 +225,16 @@ def main(args):
     np.random.seed(seed)
     random.seed(seed)
 
+    args.num_attrs = load_num_categories(args.attr_categories, default=66000)
+    args.num_rels = load_num_categories(args.rel_categories, default=40000)
+    args.ds_info = CN(json.load(open(args.ds_info)))
+    dataset = get_data(args, args.ds_info)
+
     model, criterion, postprocessors = build_model(args)
+    if args.ds_name != 'pretrain' and args.attr_neg_samples > 0:
+        model.attr_emb.set_frequency(dataset['train'].attr_frequency())
+    if args.ds_name != 'pretrain' and args.rel_head == 'adaptive':
+        model.rel_emb.set_frequency(dataset['train'].rel_frequency())
     model.to(device)
 
     model_without_ddp = model
@@ -185,22 +258,31 @@ def main(args):
 
 #    dataset_train = build_dataset(image_set='train', args=args)
 #    dataset_val = build_dataset(image_set='val', args=args)
-    args.ds_info = CN(json.load(open(args.ds_info)))
-    dataset = get_data(args, args.ds_info)
+    # The train order only depends on the seed and the epoch, so that a step checkpoint
+    # can resume it, see SkipBatchSampler
     if args.distributed:
-        sampler_train = DistributedSampler(dataset['train'])
-        sampler_val = DistributedSampler(dataset['val'], shuffle=False)
+        sampler_train = DistributedSampler(dataset['train'], seed=args.seed)
     else:
-        sampler_train = torch.utils.data.RandomSampler(dataset['train'])
-        sampler_val = torch.utils.data.SequentialSampler(dataset['val'])
-
-    batch_sampler_train = torch.utils.data.BatchSampler(
-        sampler_train, args.batch_size, drop_last=True)
+        sampler_train = DistributedSampler(dataset['train'], num_replicas=1, rank=0, seed=args.seed)
+    # every val sample is evaluated once, see engine.evaluate
+    sampler_val = make_data_sampler(dataset['val'], False, args.distributed, pad=False)
+
+    # pinned batches for the non_blocking copies of DevicePrefetcher
+    pin_memory = device.type == 'cuda'
+    batch_sampler_train = SkipBatchSampler(torch.utils.data.BatchSampler(
+        sampler_train, args.batch_size, drop_last=True))
+    # the worker seeds are drawn from this generator, seeded by the epoch, rather than from
+    # the global generator, whose state a step checkpoint restores in the middle of the epoch.
+    # A resumed epoch hands its batches to other workers than the uninterrupted one, so
+    # random draws in the workers would differ, the loading pipeline has none.
+    loader_generator = torch.Generator()
 
     data_loader_train = DataLoader(dataset['train'], batch_sampler=batch_sampler_train,
-                                   collate_fn=collater, num_workers=args.num_workers)
+                                   collate_fn=collater, num_workers=args.num_workers,
+                                   pin_memory=pin_memory, generator=loader_generator)
     data_loader_val = DataLoader(dataset['val'], args.batch_size, sampler=sampler_val,
-                                 drop_last=False, collate_fn=collater, num_workers=args.num_workers)
+                                 drop_last=False, collate_fn=collater, num_workers=args.num_workers,
+                                 pin_memory=pin_memory)
 
 #    if args.dataset_file == "coco_panoptic":
 #        # We also evaluate AP during panoptic training, on original coco DS
@@ -213,18 +295,26 @@ def main(args):
         checkpoint = torch.load(args.frozen_weights, map_location='cpu')
         model_without_ddp.detr.load_state_dict(checkpoint['model'])
 
+    start_step, logger_state, iou_meter_state = 0, None, None
     if args.resume:
         print("Use resume :", args.resume)
-        if args.resume.startswith('https'):
-            checkpoint = torch.hub.load_state_dict_from_url(
-                args.resume, map_location='cpu', check_hash=True)
-        else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
-        model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
+        checkpoint = load_checkpoint(args.resume)
+        load_model_state(model_without_ddp, checkpoint)
         if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
             optimizer.load_state_dict(checkpoint['optimizer'])
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
             args.start_epoch = checkpoint['epoch'] + 1
+            if 'step' in checkpoint:
+                # step checkpoint, continue its epoch from the next batch
+                args.start_epoch = checkpoint['epoch']
+                start_step = checkpoint['step']
+                logger_state = checkpoint['metric_logger']
+                batch_sampler_train.skip_batches(args.start_epoch, start_step)
+                rng_states = checkpoint['rng_states']
+                if len(rng_states) == utils.get_world_size():
+                    utils.set_rng_state(rng_states[utils.get_rank()])
+                    if 'iou_meters' in checkpoint:
+                        iou_meter_state = checkpoint['iou_meters'][utils.get_rank()]
 
 #    if args.eval:
 #        test_stats, coco_evaluator = evaluate(model, criterion, postprocessors,
@@ -232,46 +322,153 @@ def main(args):
 #        if args.output_dir:
 #            utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
 #        return
-    
+    iou_thresholds = tuple(float(t) for t in args.iou_thresholds.split(','))
+
+    if args.eval and args.eval_splits:
+        dataset_splits = MultiSplitDataset(dataset['test'], args.image_cache_size, args.text_cache_size)
+        sampler_splits = make_data_sampler(dataset_splits, False, args.distributed, pad=False)
+        data_loader_splits = DataLoader(dataset_splits, args.batch_size, sampler=sampler_splits,
+                                        drop_last=False, collate_fn=collater, num_workers=args.num_workers,
+                                        pin_memory=pin_memory)
+        evaluate_splits(model, criterion, data_loader_splits, device, args.output_dir, iou_thresholds)
+        return
+
     if args.eval:
-        if args.visualize_dir and utils.is_main_process():
-            args.visualize_dir = os.path.join(args.output_dir, args.visualize_dir)
-            if not os.path.exists(args.visualize_dir):
-                os.makedirs(args.visualize_dir)
-        test_stats = evaluate(model, criterion, postprocessors, data_loader_val, device, args.output_dir, visualize_dir=args.visualize_dir)
+        eval_output_dir = args.output_dir
+        if args.eval_dir:
+            # e.g. an evaluator process of a training run, apart from the training files
+            eval_output_dir = os.path.join(args.output_dir, args.eval_dir)
+            os.makedirs(eval_output_dir, exist_ok=True)
+        visualize_ids = None
+        if args.visualize_dir:
+            # every rank saves the attention maps of its own samples
+            args.visualize_dir = os.path.join(eval_output_dir, args.visualize_dir)
+            os.makedirs(args.visualize_dir, exist_ok=True)
+            if args.visualize_ids:
+                visualize_ids = [int(i) for i in args.visualize_ids.split(',')]
+        test_stats = evaluate(model, criterion, postprocessors, data_loader_val, device, eval_output_dir,
+                              visualize_dir=args.visualize_dir, eval_mode=args.eval_mode,
+                              pred_file=args.pred_file, visualize_rate=args.visualize_rate,
+                              visualize_ids=visualize_ids, iou_thresholds=iou_thresholds)
         # utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
+        if args.eval_log_epoch is not None and utils.is_main_process():
+            # evaluator process of a training run, see EvaluatorPool
+            log_stats = {**{f'test_{k}': v for k, v in test_stats.items()},
+                         'epoch': args.eval_log_epoch}
+            with open(osp.join(args.output_dir, "log.txt"), "a") as f:
+                f.write(json.dumps(log_stats) + "\n")
+        if args.eval_dir and utils.is_main_process():
+            with open(osp.join(eval_output_dir, "stats.json"), "w") as f:
+                json.dump(test_stats, f)
         return
 
     print("Start training")
     output_dir = args.output_dir
+    checkpoint_manager = None
+    if args.output_dir:
+        checkpoint_manager = CheckpointManager(output_dir, args.keep_last_checkpoints,
+                                               args.keep_best_checkpoints, args.checkpoint_metric)
+
+    def checkpoint_model_state():
+        if args.full_checkpoints:
+            return model_without_ddp.state_dict(), None
+        return slim_state_dict(model_without_ddp)
+
+    step_callbacks = []
+    evaluator_pool = None
+    subset_stats = {}
+    if args.eval_schedule == 'subset':
+        # the same random val samples at every evaluation
+        g = torch.Generator()
+        g.manual_seed(args.seed)
+        subset_ids = torch.randperm(len(dataset['val']), generator=g)[:args.eval_subset_size].tolist()
+        dataset_subset = torch.utils.data.Subset(dataset['val'], subset_ids)
+        sampler_subset = make_data_sampler(dataset_subset, False, args.distributed, pad=False)
+        data_loader_subset = DataLoader(dataset_subset, args.batch_size, sampler=sampler_subset,
+                                        drop_last=False, collate_fn=collater, num_workers=args.num_workers,
+                                        pin_memory=pin_memory)
+
+        def evaluate_subset(step, metric_logger):
+            # keep the IoUs of the training epoch apart
+            train_meter, criterion.iou_meter = criterion.iou_meter, utils.IoUMeter()
+            subset_stats.update(evaluate_fast(model, criterion, data_loader_subset, device, output_dir,
+                                              iou_thresholds=iou_thresholds))
+            criterion.iou_meter = train_meter
+            if args.output_dir and utils.is_main_process():
+                log_stats = {**{f'subset_{k}': v for k, v in subset_stats.items()},
+                             'epoch': epoch, 'step': step}
+                with open(osp.join(output_dir, "log.txt"), "a") as f:
+                    f.write(json.dumps(log_stats) + "\n")
+
+        step_callbacks.append((args.eval_steps, evaluate_subset))
+    elif args.eval_schedule == 'process' and utils.is_main_process():
+        evaluator_pool = EvaluatorPool(args.eval_workers, args.eval_device, output_dir=args.output_dir)
+
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            sampler_train.set_epoch(epoch)
-        train_stats = train_one_epoch(
-            model, criterion, data_loader_train, optimizer, device, epoch,
-            args.clip_max_norm)
-        lr_scheduler.step()
-        if args.output_dir:
-            checkpoint_paths = [osp.join(output_dir,  'checkpoint.pth')]
-            # extra checkpoint before LR drop and every 10 epochs
-            if (epoch + 1) % args.lr_drop == 0 or (epoch + 1) % 1 == 0:
-                checkpoint_paths.append(osp.join(output_dir ,f'checkpoint{epoch:04}.pth'))
-            for checkpoint_path in checkpoint_paths:
-                utils.save_on_master({
-                    'model': model_without_ddp.state_dict(),
+        batch_sampler_train.set_epoch(epoch)
+        loader_generator.manual_seed(args.seed + epoch)
+
+        def save_step_checkpoint(step, metric_logger, epoch=epoch):
+            # every rank takes part, each one restores its own generators
+            rng_states = utils.all_gather(utils.get_rng_state())
+            iou_meters = utils.all_gather(criterion.iou_meter.state_dict())
+            if checkpoint_manager is not None:
+                model_state, frozen = checkpoint_model_state()
+                checkpoint_manager.save({
+                    'model': model_state,
+                    'frozen': frozen,
                     'optimizer': optimizer.state_dict(),
                     'lr_scheduler': lr_scheduler.state_dict(),
                     'epoch': epoch,
+                    'step': step,
+                    'metric_logger': metric_logger.state_dict(),
+                    'rng_states': rng_states,
+                    'iou_meters': iou_meters,
                     'args': args,
-                }, checkpoint_path)
+                })
 
-        test_stats = evaluate(
-            model, criterion, postprocessors, data_loader_val, device, args.output_dir
-        )
+        train_stats = train_one_epoch(
+            model, criterion, data_loader_train, optimizer, device, epoch,
+            args.clip_max_norm, start_step=start_step, logger_state=logger_state,
+            iou_meter_state=iou_meter_state,
+            step_callbacks=[(args.checkpoint_steps, save_step_checkpoint)] + step_callbacks,
+            deferred_logging=args.deferred_logging)
+        start_step, logger_state, iou_meter_state = 0, None, None
+        lr_scheduler.step()
 
+        if args.eval_schedule == 'epoch':
+            test_stats = evaluate(
+                model, criterion, postprocessors, data_loader_val, device, args.output_dir,
+                eval_mode=args.eval_mode, pred_file=args.pred_file, iou_thresholds=iou_thresholds
+            )
+        else:
+            # the subset stats of the last evaluation, the evaluator processes log their own
+            test_stats = dict(subset_stats)
+
+        if checkpoint_manager is not None:
+            # written in the background, the per-epoch checkpoint is retained by recency or test
+            # metric, the subset stats do not rank the checkpoints
+            model_state, frozen = checkpoint_model_state()
+            checkpoint_manager.save({
+                'model': model_state,
+                'frozen': frozen,
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'args': args,
+            }, epoch, test_stats if args.eval_schedule == 'epoch' else None,
+                on_saved=(lambda path, epoch=epoch: evaluator_pool.submit(path, epoch))
+                if evaluator_pool is not None else None,
+                pending_metric=evaluator_pool is not None)
+        if evaluator_pool is not None and checkpoint_manager is not None:
+            # the evaluators that finished rank their checkpoints
+            for eval_epoch, eval_stats in evaluator_pool.poll():
+                checkpoint_manager.set_metric(eval_epoch, eval_stats)
+
+        test_prefix = 'test_' if args.eval_schedule == 'epoch' else 'subset_'
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                     **{f'test_{k}': v for k, v in test_stats.items()},
+                     **{f'{test_prefix}{k}': v for k, v in test_stats.items()},
                      'epoch': epoch,
                      'n_parameters': n_parameters}
 
@@ -279,6 +476,22 @@ def main(args):
             with open(osp.join(output_dir,"log.txt"), "a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    if args.eval_schedule != 'epoch':
+        # full split evaluation of the final model
+        test_stats = evaluate(
+            model, criterion, postprocessors, data_loader_val, device, args.output_dir,
+            eval_mode=args.eval_mode, pred_file=args.pred_file, iou_thresholds=iou_thresholds
+        )
+        if args.output_dir and utils.is_main_process():
+            with open(osp.join(output_dir, "log.txt"), "a") as f:
+                f.write(json.dumps({**{f'test_{k}': v for k, v in test_stats.items()},
+                                    'epoch': args.epochs - 1, 'final': True}) + "\n")
+    if evaluator_pool is not None:
+        for eval_epoch, eval_stats in evaluator_pool.close():
+            if checkpoint_manager is not None:
+                checkpoint_manager.set_metric(eval_epoch, eval_stats)
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
@@ -93,6 +93,8 @@ class Backbone(BackboneBase):
         if yolo_path:
             backbone.load_state_dict(torch.load(yolo_path), strict=False)
         super().__init__(backbone, train_backbone, num_channels, return_interm_layers)
+        # where the frozen weights come from, recorded in the slim checkpoints
+        self.pretrained_source = 'torchvision:' + name + (',' + yolo_path if yolo_path else '')
 
 
 class Joiner(nn.Sequential):
@@ -1,6 +1,8 @@
 """
 RDETR model and criterion classes.
 """
+from typing import NamedTuple
+
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -10,24 +12,24 @@ from transformers import RobertaModel, RobertaTokenizerFast
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate,
-                       is_dist_avail_and_initialized, IoU_values)
+                       is_dist_avail_and_initialized, paired_IoU_values, IoUMeter)
 
 from .backbone import build_backbone
-from .matcher import build_matcher
+from .matcher import FirstMatcher, build_matcher
 from .transformer import build_transformer, FeatureResizer
 from .position_encoding import WordPositionEmbeddingSine
 from .vilbert import BertLMPredictionHead
 
 
-CORRECT_IOUS = []
-WRONG_IOUS = []
 
 
 class DETR(nn.Module):
     """ This is the DETR module that performs object detection """
     def __init__(self, backbone, transformer, num_classes, num_queries, aux_loss=False, 
                  query_pos='sine', matcher='hungarian', is_pretrain=False, bert_type=None,
-                 use_mlm=False, no_img=False, no_obj_att=False):
+                 use_mlm=False, no_img=False, no_obj_att=False, candidate_heads=False,
+                 num_attrs=66000, attr_neg_samples=0, num_rels=40000, rel_head='mlp',
+                 rel_cutoffs=None):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -40,6 +42,16 @@ class DETR(nn.Module):
             matcher: method of matching between gt and prediction bboxes
             is_pretrain: whether to pretrain or not
             bert_type: pretrained model of bert
+            candidate_heads: apply the box and class heads to the candidate words only, i.e. the
+                             object-labeled words in training, the nouns at inference (the labeled
+                             words under the constant matcher, which indexes them)
+            num_attrs: size of the attribute vocabulary
+            attr_neg_samples: if > 0, the attribute head only scores the positive attributes of the
+                              batch and this many sampled negatives during training
+            num_rels: size of the predicate vocabulary
+            rel_head: 'mlp' for a dense classifier, 'adaptive' for an adaptive softmax whose clusters
+                      hold the predicates sorted by training frequency
+            rel_cutoffs: cluster boundaries of the adaptive softmax
         """
         super().__init__()
         self.is_pretrain = is_pretrain
@@ -49,6 +61,9 @@ class DETR(nn.Module):
         self.use_mlm = use_mlm
         self.no_img = no_img
         self.no_obj_att = no_obj_att
+        self.candidate_heads = candidate_heads
+        self.matcher = matcher
+        self.rel_head = rel_head
         hidden_dim = transformer.d_model
         # self.query_embed = nn.Embedding(num_queries, hidden_dim)
         # Map language to hidden_dim
@@ -86,8 +101,11 @@ class DETR(nn.Module):
                 self.text_sim = nn.Linear(hidden_dim, hidden_dim)
             self.class_emb = nn.Linear(hidden_dim, num_classes + 1) if matcher != 'first' else None
             self.bbox_embed = MLP(hidden_dim, hidden_dim, 4, 3)
-            self.attr_emb = nn.Linear(hidden_dim, 66000)
-            self.rel_emb = MLP(hidden_dim * 2, hidden_dim * 2, 40000, 3)
+            self.attr_emb = SampledLinear(hidden_dim, num_attrs, num_samples=attr_neg_samples)
+            if rel_head == 'adaptive':
+                self.rel_emb = AdaptiveRelHead(hidden_dim * 2, hidden_dim * 2, num_rels, rel_cutoffs, 3)
+            else:
+                self.rel_emb = MLP(hidden_dim * 2, hidden_dim * 2, num_rels, 3)
         if query_pos == 'learned':
             self.query_pos = nn.Embedding(num_queries, hidden_dim)
         elif query_pos == 'sine':
@@ -95,11 +113,17 @@ class DETR(nn.Module):
         else:
             self.query_pos = None
     
-    def forward(self, samples: NestedTensor, word_emb, targets, visualize=False):
+    def forward(self, samples: NestedTensor, word_emb, targets, visualize=False, att_layers=None,
+                boxes_only=False):
         """ The forward expects a NestedTensor, which consists of:
                - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
                - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
                word_emb: NestedTensor or str
+               visualize: whether to return attention maps. They are not computed otherwise.
+               att_layers: optional list of layer indices whose attention maps are returned
+                           when visualizing. All layers by default.
+               boxes_only: only return "pred_logits" and "pred_boxes", the attribute, relation,
+                           object attention and MLM heads are skipped. Used by the fast evaluation.
 
             It returns a dict with the following elements:
                - "pred_logits": the classification logits (including no-object) for all queries.
@@ -108,8 +132,9 @@ class DETR(nn.Module):
                                (center_x, center_y, height, width). These values are normalized in [0, 1],
                                relative to the size of each individual image (disregarding possible padding).
                                See PostProcess for information on how to retrieve the unnormalized bounding box.
-               - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                                dictionnaries containing the two above keys for each decoder layer.
+               - "aux_outputs": Optional, only returned when auxilary losses are activated and the model
+                                is training. It is a list of dictionnaries containing the two above keys
+                                for each decoder layer. Otherwise the heads only run on the last layer.
         """
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
@@ -140,39 +165,75 @@ class DETR(nn.Module):
 #            query_pos = torch.zeros_like(query_pos)
         b, l, _ = query.shape
         query_pos = query_pos[:l]
-        visual_dict, _ = self.transformer(query, src, mask, query_pos, pos, lang_mask)
+        # Intermediate decoder layers are only consumed by the auxiliary losses during training
+        use_aux = self.aux_loss and self.training
+        visual_dict, _ = self.transformer(query, src, mask, query_pos, pos, lang_mask,
+                                          return_att=visualize, att_layers=att_layers,
+                                          return_intermediate=use_aux)
         if not self.is_pretrain:
             hs = visual_dict['hs']
-            outputs_coord = self.bbox_embed(hs).sigmoid()
-            outputs_class = self.class_emb(hs) if self.class_emb is not None else outputs_coord 
+            if self.candidate_heads:
+                outputs_coord, outputs_class = self._candidate_heads(hs, self._candidate_mask(targets))
+            else:
+                outputs_coord = self.bbox_embed(hs).sigmoid()
+                outputs_class = self.class_emb(hs) if self.class_emb is not None else outputs_coord 
+            if boxes_only:
+                return {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1]}
             d_num = len(outputs_class)
+            attr_classes = None
             if len(targets['batch_attr']) == 0:
                 outputs_attr = [None] * d_num
             else:
-                outputs_attr = self.attr_emb(hs[:, targets['batch_attr'], targets['attr_ids']])
+                attr_hs = hs[:, targets['batch_attr'], targets['attr_ids']]
+                if self.training and self.attr_emb.num_samples > 0:
+                    attr_classes = self.attr_emb.sample_classes(targets['attr_labels'])
+                outputs_attr = self.attr_emb(attr_hs, attr_classes)
             if len(targets['batch_rel']) == 0:
                 outputs_rel = [None] * d_num
             else:
                 sub_hs = hs[:, targets['batch_rel'], targets['sub_ids']]
                 obj_hs = hs[:, targets['batch_rel'], targets['obj_ids']]
-                outputs_rel = self.rel_emb(torch.cat([obj_hs, sub_hs], dim=-1))
+                if self.rel_head == 'adaptive':
+                    rel_log_prob, rel_pred = self.rel_emb(torch.cat([obj_hs, sub_hs], dim=-1),
+                                                          targets['rel_labels'])
+                    outputs_rel = [AdaptiveRelOutput(lp, p) for lp, p in zip(rel_log_prob, rel_pred)]
+                else:
+                    outputs_rel = self.rel_emb(torch.cat([obj_hs, sub_hs], dim=-1))
             out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1],\
                 'pred_attrs': outputs_attr[-1], 'pred_rels': outputs_rel[-1]}
+            if attr_classes is not None:
+                out['attr_classes'] = attr_classes
             if not self.no_obj_att:
-                cross_lang = self.text_sim(visual_dict['cross_lang']).unsqueeze(2)  # b * L * 1 * c
-                cross_img = self.visual_sim(visual_dict['cross_img']).unsqueeze(1)  # b * 1 * (h*w) * c
-                pred_obj_att = (cross_lang * cross_img).sum(dim=-1).view(b, l, h, w)
-                out['pred_obj_att'] = pred_obj_att
+                cross_lang = self.text_sim(visual_dict['cross_lang'])  # b * L * c
+                cross_img = self.visual_sim(visual_dict['cross_img'])  # b * (h*w) * c
+                if visualize:
+                    pred_obj_att = torch.bmm(cross_lang, cross_img.transpose(1, 2)).view(b, l, h, w)
+                    out['pred_obj_att'] = pred_obj_att
+                else:
+                    # The dense b * L * h * w map is only built for visualization, the loss
+                    # computes the logits of the matched words only, see obj_att_logits
+                    out['obj_att_text'] = cross_lang
+                    out['obj_att_img'] = cross_img
+                    out['obj_att_size'] = (h, w)
            
             if self.use_mlm:
                 cross_lang = visual_dict['cross_lang']
-                out['text_pred'] = self.mlm_pred(cross_lang)
-            if self.aux_loss:
+                out['text_pred'] = self._mlm_predict(self.mlm_pred, cross_lang, targets)
+            if use_aux:
                 out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord,\
                     outputs_attr, outputs_rel)
+                if attr_classes is not None:
+                    for aux_outputs in out['aux_outputs']:
+                        aux_outputs['attr_classes'] = attr_classes
+                # The same outputs kept stacked as D-1 * ..., for SetCriterion batched_aux
+                out['aux_stacked'] = self._stack_aux_loss(outputs_class, outputs_coord,
+                                                          outputs_attr, outputs_rel)
+                if attr_classes is not None:
+                    out['aux_stacked']['attr_classes'] = attr_classes
             if visualize:
-                out['self_att'] = visual_dict['self_att'].cpu().detach().transpose(0, 1).tolist()  # NxBxLxS -> BxNxLxS
-                out['cross_att'] = visual_dict['cross_att'].cpu().detach().transpose(0, 1).tolist()
+                # kept on the device, util.visualize.AttentionDumper copies them off the hot path
+                out['self_att'] = visual_dict['self_att'].detach().transpose(0, 1)  # NxBxLxS -> BxNxLxS
+                out['cross_att'] = visual_dict['cross_att'].detach().transpose(0, 1)
                 out['size'] = [h, w]
         else:
             cross_lang = visual_dict['cross_lang']
@@ -180,16 +241,82 @@ class DETR(nn.Module):
                 match_pred = self.match_pred(cross_lang[:, 0])
                 out = {
                     "match_pred": match_pred,
-                    "cross_att": visual_dict['cross_att']  # H * B * L * h * w
                 }
+                if visualize:
+                    out['cross_att'] = visual_dict['cross_att']  # H * B * L * h * w
             else:
                 out = {}
-            text_pred = self.text_pred(cross_lang)
+            text_pred = self._mlm_predict(self.text_pred, cross_lang, targets)
             out['text_pred'] = text_pred
             
         return out
 
 
+    def _mlm_predict(self, head, cross_lang, targets):
+        """ Applies a MLM head to the masked words only (text_labels != -1) when the labels are
+        given, which returns a N * vocab tensor instead of b * L * vocab
+        """
+        if 'text_labels' not in targets:
+            return head(cross_lang)
+        return head(cross_lang[targets['text_labels'] != -1])
+
+    def _candidate_mask(self, targets):
+        """ Words the heads are applied to. In training, and under the constant matcher which
+        indexes them, the object-labeled words. At inference otherwise the labels are not looked
+        at: the nouns, or every word when they are not given. The first matcher predicts with
+        the first word, which is always a candidate.
+        """
+        labels, pad_mask = targets['labels'].decompose()
+        if self.training or self.matcher not in ('hungarian', 'max', 'first'):
+            cand_mask = ~pad_mask & (labels[..., 0] == 0)
+        elif 'noun_labels' in targets:
+            cand_mask = ~pad_mask & (targets['noun_labels'].tensors[..., 0] == 1)
+        else:
+            cand_mask = ~pad_mask
+        if self.matcher == 'first':
+            cand_mask = cand_mask.clone()
+            cand_mask[:, 0] = True
+        return cand_mask
+
+    def _candidate_heads(self, hs, cand_mask):
+        """ Applies the box and class heads to the candidate words only and scatters the results
+        back to D * b * L. Other words get an empty box and are classified as no-object.
+        """
+        d, b, l, _ = hs.shape
+        cand_hs = hs[:, cand_mask]  # D * N * c
+        outputs_coord = hs.new_zeros(d, b, l, 4)
+        outputs_coord[:, cand_mask] = self.bbox_embed(cand_hs).sigmoid()
+        if self.class_emb is None:
+            return outputs_coord, outputs_coord
+        outputs_class = hs.new_zeros(d, b, l, self.class_emb.out_features)
+        outputs_class[..., :-1] = -1e4
+        outputs_class[:, cand_mask] = self.class_emb(cand_hs)
+        return outputs_coord, outputs_class
+
+    def pretrained_sources(self):
+        """ Submodules initialized from pretrained files, as {state_dict prefix: source}.
+        Their frozen tensors are left out of the slim checkpoints, see util.checkpoint
+        """
+        sources = {}
+        if self.bert_type is not None:
+            sources['bert_model.'] = self.bert_type
+        if not self.no_img and getattr(self.backbone[0], 'pretrained_source', None):
+            sources['backbone.'] = self.backbone[0].pretrained_source
+        return sources
+
+    @torch.jit.unused
+    def _stack_aux_loss(self, outputs_class, outputs_coord, outputs_attr, outputs_rel):
+        pred_attrs = outputs_attr[:-1] if torch.is_tensor(outputs_attr) else None
+        if torch.is_tensor(outputs_rel):
+            pred_rels = outputs_rel[:-1]
+        elif isinstance(outputs_rel[-1], AdaptiveRelOutput):
+            pred_rels = AdaptiveRelOutput(torch.stack([o.log_prob for o in outputs_rel[:-1]]),
+                                          torch.stack([o.pred for o in outputs_rel[:-1]]))
+        else:
+            pred_rels = None
+        return {'pred_logits': outputs_class[:-1], 'pred_boxes': outputs_coord[:-1],
+                'pred_attrs': pred_attrs, 'pred_rels': pred_rels}
+
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord, outputs_attr, outputs_rel):
         # this is a workaround to make torchscript happy, as torchscript
@@ -206,7 +333,8 @@ class SetCriterion(nn.Module):
         1) we compute hungarian assignment between ground truth boxes and the outputs of the model
         2) we supervise each pair of matched ground-truth / prediction (supervise class and box)
     """
-    def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses, is_pretrain=False):
+    def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses, is_pretrain=False,
+                 batched_aux=False):
         """ Create the criterion.
         Parameters:
             num_classes: number of object categories, omitting the special no-object category
@@ -214,6 +342,8 @@ class SetCriterion(nn.Module):
             weight_dict: dict containing as key the names of the losses and as values their relative weight.
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses.
+            batched_aux: compute the class, box, attribute and relation losses of all the intermediate
+                         decoder layers together, from the stacked outputs, instead of layer by layer
         """
         super().__init__()
         self.num_classes = num_classes
@@ -222,9 +352,12 @@ class SetCriterion(nn.Module):
         self.eos_coef = eos_coef
         self.losses = losses
         self.acc_iou_threshold = 0.5
+        # IoUs of the final layer predictions, reset and read by the engine
+        self.iou_meter = IoUMeter()
         empty_weight = torch.ones(self.num_classes + 1)
         empty_weight[-1] = self.eos_coef
         self.is_pretrain = is_pretrain
+        self.batched_aux = batched_aux
         self.register_buffer('empty_weight', empty_weight)
 
     def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
@@ -265,8 +398,52 @@ class SetCriterion(nn.Module):
         return losses
 
     @torch.no_grad()
-    def loss_accuracy(self, outputs, targets, indices, num_boxes):
-        """ Compute the accuracy """
+    def loss_accuracy(self, outputs, targets, indices, num_boxes, log=True):
+        """ Compute the accuracy, and record the IoUs in iou_meter when log is set """
+        _, _, ious = self._matched_boxes(outputs, targets, indices)
+        if log:
+            # NaN IoUs are counted by the meter, and count as wrong in the accuracy
+            self.iou_meter.update(ious)
+        return {
+            "accuracy": (ious >= self.acc_iou_threshold).float().mean(),
+        }
+
+    @torch.no_grad()
+    def match_boxes(self, outputs, targets):
+        """ Matches the final predictions to the targets and records their IoUs in iou_meter,
+        without computing any loss. Returns the matched predictions, see matched_predictions.
+        """
+        preds = self.matched_predictions(outputs, targets)
+        self.iou_meter.update(preds['iou'])
+        return preds
+
+    @torch.no_grad()
+    def matched_predictions(self, outputs, targets, indices=None):
+        """ One row per matched word: the sample idx and image_id, the predicted and target
+        tokens, the predicted and ground truth boxes (x0, y0, x1, y1 in pixels), the IoU and
+        the object score. The FirstMatcher always picks the first token whatever its score,
+        so there is no score then.
+        indices: the matching of the final layer, e.g. returned by forward, matched here if None
+        """
+        if indices is None:
+            indices = self.matcher(outputs, targets)
+        boxes, gt_boxes, ious = self._matched_boxes(outputs, targets, indices)
+        batch_idx, src_idx = self._get_src_permutation_idx(indices)
+        preds = {
+            'idx': targets['idxs'][batch_idx],
+            'token': src_idx,
+            'tgt_token': indices.tgt_idx,
+            'box': boxes,
+            'gt_box': gt_boxes,
+            'iou': ious,
+        }
+        if not isinstance(self.matcher, FirstMatcher):
+            preds['score'] = outputs['pred_logits'][batch_idx, src_idx].softmax(-1)[:, 0]
+        if 'image_id' in targets:
+            preds['image_id'] = targets['image_id'][batch_idx]
+        return preds
+
+    def _matched_boxes(self, outputs, targets, indices):
         # pred_logits = outputs['pred_logits'][:, :, 0]  # '0' rep objects
         # _, ids = pred_logits.max(1)
         ids = self._get_src_permutation_idx(indices)
@@ -279,25 +456,21 @@ class SetCriterion(nn.Module):
         # pred_boxes = pred_boxes.view(-1, 4)
         pred_boxes = results[ids]
         target_bboxs = gt[tgt_ids]
-        ious = torch.diag(IoU_values(pred_boxes, target_bboxs))
-        CORRECT_IOUS.extend(ious[ious >= self.acc_iou_threshold].tolist())
-        WRONG_IOUS.extend(ious[ious < self.acc_iou_threshold].tolist())
-        # import pdb
-        # pdb.set_trace()
-        if torch.isnan(ious).sum() > 0 or torch.isnan((ious >= self.acc_iou_threshold).float().mean()):
-            import pdb
-            pdb.set_trace()
-        return {
-            "accuracy": (ious >= self.acc_iou_threshold).float().mean(),
-        }
+        return pred_boxes, target_bboxs, paired_IoU_values(pred_boxes, target_bboxs)
 
-    @torch.no_grad()
-    def loss_mlm_acc(self, outputs, targets):
+    def _mlm_pred_labels(self, outputs, targets):
+        """ Flattened MLM predictions and their labels """
         text_pred = outputs['text_pred']
         text_labels = targets['text_labels']
+        if text_pred.dim() == 2:
+            # The head only ran on the masked words
+            return text_pred, text_labels[text_labels != -1]
         B, T, _ = text_pred.shape
-        text_pred = text_pred.view(B * T, -1)
-        text_labels = text_labels.view(B * T)
+        return text_pred.view(B * T, -1), text_labels.view(B * T)
+
+    @torch.no_grad()
+    def loss_mlm_acc(self, outputs, targets):
+        text_pred, text_labels = self._mlm_pred_labels(outputs, targets)
         _, ids = text_pred.max(1)
         num_pred = (text_labels != -1).float().sum() + 1e-6
         return {"mlm_acc": (ids == text_labels).float().sum() / num_pred}
@@ -310,11 +483,7 @@ class SetCriterion(nn.Module):
         return {"match_acc": (ids == is_match).float().mean()}        
 
     def loss_mlm(self, outputs, targets):
-        text_pred = outputs['text_pred']
-        text_labels = targets['text_labels']
-        B, T, _ = text_pred.shape
-        text_pred = text_pred.view(B * T, -1)
-        text_labels = text_labels.view(B * T)
+        text_pred, text_labels = self._mlm_pred_labels(outputs, targets)
         loss = F.cross_entropy(text_pred + 1e-8, text_labels, ignore_index=-1)
         # torch.clip_(loss, min=1e-6, max=20)
         return {"loss_mlm": loss}
@@ -341,9 +510,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -378,14 +547,17 @@ class SetCriterion(nn.Module):
 
     def loss_obj_att(self, outputs, targets, indices, num_bboxs):
         ids = self._get_src_permutation_idx(indices)
-        pred_att = outputs['pred_obj_att']
         gt_att = targets['obj_maps']
         # seq_mask = (targets['labels'].tensors == 0).float().unsqueeze(-1)
         # bs, seq_len = targets['labels'].mask.shape
         # seq_mask = (~targets['labels'].mask & (targets['labels'].tensors.view(bs, seq_len) == 0)).float()
         # seq_mask = seq_mask.view(bs, seq_len, 1, 1)
         # att_mask = ((~gt_att.mask.unsqueeze(1)).float() * seq_mask).bool()
-        pred_att = pred_att[ids]
+        if 'pred_obj_att' in outputs:
+            pred_att = outputs['pred_obj_att'][ids]
+        else:
+            pred_att = obj_att_logits(outputs['obj_att_text'], outputs['obj_att_img'], *ids)
+            pred_att = pred_att.view(-1, *outputs['obj_att_size'])
         gt_obj_att = gt_att.tensors[ids]
         # att_mask = F.interpolate(att_mask, size=pred_att.shape[-2:]).to(torch.bool)
         # gt_obj_att = F.interpolate(gt_obj_att, size=pred_att.shape[-2:])
@@ -403,6 +575,9 @@ class SetCriterion(nn.Module):
             return {
                 "loss_attr": torch.tensor(0.).to(outputs['pred_logits'].device)
             }
+        if 'attr_classes' in outputs:
+            # Sampled head, only the scored attributes are supervised
+            gt_attr = gt_attr[:, outputs['attr_classes']]
         return {
             "loss_attr": F.binary_cross_entropy_with_logits(pred_attr, gt_attr)
         }
@@ -414,6 +589,10 @@ class SetCriterion(nn.Module):
             return {
                 "loss_rel": torch.tensor(0.).to(outputs['pred_logits'].device)
             }
+        if isinstance(pred_rel, AdaptiveRelOutput):
+            return {
+                "loss_rel": -pred_rel.log_prob.mean()
+            }
         return {
             "loss_rel": F.cross_entropy(pred_rel, gt_rel,)
         }
@@ -423,21 +602,20 @@ class SetCriterion(nn.Module):
             return {
                 "loss_rel_acc": torch.tensor(0.).to(outputs['pred_logits'].device)
             }
-        _, pred_rel = outputs['pred_rels'].max(1)
+        if isinstance(outputs['pred_rels'], AdaptiveRelOutput):
+            pred_rel = outputs['pred_rels'].pred
+        else:
+            _, pred_rel = outputs['pred_rels'].max(1)
         return {
             "loss_rel_acc": (pred_rel == targets['rel_labels']).float().mean()
         }
     def _get_src_permutation_idx(self, indices):
-        # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
-        src_idx = torch.cat([src for (src, _) in indices])
-        return batch_idx, src_idx
+        # permute predictions following indices, see matcher.MatchIndices
+        return indices.batch_idx, indices.src_idx
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
-        tgt_idx = torch.cat([tgt for (_, tgt) in indices])
-        return batch_idx, tgt_idx
+        return indices.batch_idx, indices.tgt_idx
 
     def get_loss(self, loss, outputs, targets, indices=None, num_boxes=None, **kwargs):
         loss_map = {
@@ -462,30 +640,41 @@ class SetCriterion(nn.Module):
         else:
             return loss_map[loss](outputs, targets)
 
-    def forward(self, outputs, targets):
+    def forward(self, outputs, targets, return_indices=False):
         """ This performs the loss computation.
         Parameters:
              outputs: dict of tensors, see the output specification of the model for the format
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
+             return_indices: also return the matching of the final layer (None when pretraining),
+                             e.g. for matched_predictions
         """
-        outputs_without_aux = {k: v for k, v in outputs.items() if k not in ['aux_outputs']}
+        outputs_without_aux = {k: v for k, v in outputs.items() if k not in ['aux_outputs', 'aux_stacked']}
+        aux_outputs_list = outputs.get('aux_outputs', [])
         losses = {}
         indices = None
+        aux_indices = None
         num_boxes = None
         if not self.is_pretrain:
             # Retrieve the matching between the outputs of the last layer and the targets
-            indices = self.matcher(outputs_without_aux, targets)
+            # Match every decoder layer in one call
+            indices, *aux_indices = self.matcher.match_layers(
+                [outputs_without_aux] + list(aux_outputs_list), targets)
 
             # Compute the average number of target boxes accross all nodes, for normalization purposes
             # num_boxes = sum(len(t) for t in targets['labels'].tensors)
             # num_boxes = (targets['labels'].tensors == 0).float().sum()
             # num_boxes = targets['boxes'].size(0)
-            num_boxes = sum(len(i) for (i, j) in indices)
+            num_boxes = len(indices.batch_idx)
             num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
-            if is_dist_avail_and_initialized():
+            # Only in training: the evaluation shards are unequal, the ranks may not run
+            # the same number of batches, and the normalization is per rank there
+            if self.training and is_dist_avail_and_initialized():
                 torch.distributed.all_reduce(num_boxes)
-            num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
+                num_boxes = num_boxes / get_world_size()
+            # kept on the device, .item() would synchronize every step
+            num_boxes = torch.clamp(num_boxes, min=1)[0]
+        final_indices = indices
         # Compute all the requested losses
         for loss in self.losses:
             if loss in ['mlm', 'match', 'mlm_acc', 'match_acc']:
@@ -494,23 +683,122 @@ class SetCriterion(nn.Module):
                 losses.update(self.get_loss(loss, outputs_without_aux, targets, indices, num_boxes))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
-        if 'aux_outputs' in outputs:
+        if 'aux_outputs' in outputs and self.batched_aux and 'aux_stacked' in outputs:
+            losses.update(self._batched_aux_losses(outputs['aux_stacked'], outputs['aux_outputs'],
+                                                   targets, aux_indices, num_boxes))
+        elif 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+                indices = aux_indices[i]
                 for loss in self.losses:
                     if loss in ['masks', 'mlm', 'mlm_acc', 'obj_att']:
                         # Intermediate masks losses are too costly to compute, we ignore them.
                         continue
                     kwargs = {}
-                    if loss == 'labels':
+                    if loss in ['labels', 'accuracy']:
                         # Logging is enabled only for the last layer
                         kwargs = {'log': False}
                     l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes, **kwargs)
                     l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                     losses.update(l_dict)
 
+        if return_indices:
+            return losses, final_indices
+        return losses
+
+    def _batched_aux_losses(self, stacked, aux_outputs, targets, aux_indices, num_boxes):
+        """ Losses of the intermediate decoder layers, computed for all the layers at once.
+        Produces the same '{loss}_{i}' entries as the layer by layer loop of forward.
+        Parameters:
+            stacked: the outputs of the intermediate layers stacked in a leading layer dim, see DETR
+            aux_outputs: the same outputs as a list of dicts, for the losses without a batched version
+            aux_indices: the MatchIndices of each intermediate layer
+        """
+        num_layers = len(aux_indices)
+        layer_idx = torch.cat([torch.full_like(ind.batch_idx, i) for i, ind in enumerate(aux_indices)])
+        idx = (layer_idx,
+               torch.cat([ind.batch_idx for ind in aux_indices]),
+               torch.cat([ind.src_idx for ind in aux_indices]),
+               torch.cat([ind.tgt_idx for ind in aux_indices]))
+        batched_loss_map = {
+            'labels': self._batched_loss_labels,
+            'boxes': self._batched_loss_boxes,
+            'attr': self._batched_loss_attr,
+            'rel': self._batched_loss_rel,
+            'rel_acc': self._batched_loss_rel_acc,
+        }
+        losses = {}
+        for loss in self.losses:
+            if loss in ['masks', 'mlm', 'mlm_acc', 'obj_att']:
+                continue
+            if loss in batched_loss_map:
+                l_dict = batched_loss_map[loss](stacked, targets, idx, num_layers, num_boxes)
+                for k, v in l_dict.items():
+                    losses.update({k + f'_{i}': v[i] for i in range(num_layers)})
+            else:
+                for i, (outputs, indices) in enumerate(zip(aux_outputs, aux_indices)):
+                    kwargs = {'log': False} if loss == 'accuracy' else {}
+                    l_dict = self.get_loss(loss, outputs, targets, indices, num_boxes, **kwargs)
+                    losses.update({k + f'_{i}': v for k, v in l_dict.items()})
         return losses
 
+    def _batched_loss_labels(self, stacked, targets, idx, num_layers, num_boxes):
+        layer_idx, batch_idx, src_idx, tgt_idx = idx
+        src_logits = stacked['pred_logits']  # D * b * L * (num_classes + 1)
+        target_classes = torch.full(src_logits.shape[:3], self.num_classes,
+                                    dtype=torch.int64, device=src_logits.device)
+        target_classes[layer_idx, batch_idx, src_idx] = targets['labels'].tensors[batch_idx, tgt_idx][:, 0]
+        loss_ce = F.cross_entropy(src_logits.flatten(0, 1).transpose(1, 2), target_classes.flatten(0, 1),
+                                  self.empty_weight, reduction='none')
+        # weighted mean of each layer, as F.cross_entropy does with reduction='mean'
+        weights = self.empty_weight[target_classes]
+        loss_ce = loss_ce.view(num_layers, -1).sum(1) / weights.view(num_layers, -1).sum(1)
+        return {'loss_ce': loss_ce}
+
+    def _batched_loss_boxes(self, stacked, targets, idx, num_layers, num_boxes):
+        layer_idx, batch_idx, src_idx, tgt_idx = idx
+        src_boxes = stacked['pred_boxes'][layer_idx, batch_idx, src_idx]
+        target_boxes = targets['cthw'].tensors[batch_idx, tgt_idx]
+        loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none').sum(1)
+        giou = box_ops.paired_generalized_box_iou(box_ops.box_cxcywh_to_xyxy(src_boxes),
+                                                  box_ops.box_cxcywh_to_xyxy(target_boxes))
+        zeros = src_boxes.new_zeros(num_layers)
+        return {
+            'loss_bbox': zeros.index_add(0, layer_idx, loss_bbox) / num_boxes,
+            'loss_giou': zeros.index_add(0, layer_idx, 1 - giou) / num_boxes,
+        }
+
+    def _batched_loss_attr(self, stacked, targets, idx, num_layers, num_boxes):
+        pred_attr = stacked['pred_attrs']  # D * N * num_attrs
+        if pred_attr is None:
+            return {'loss_attr': stacked['pred_logits'].new_zeros(num_layers)}
+        gt_attr = targets['attr_labels']
+        if 'attr_classes' in stacked:
+            gt_attr = gt_attr[:, stacked['attr_classes']]
+        loss_attr = F.binary_cross_entropy_with_logits(pred_attr, gt_attr.expand_as(pred_attr),
+                                                       reduction='none')
+        return {'loss_attr': loss_attr.flatten(1).mean(1)}
+
+    def _batched_loss_rel(self, stacked, targets, idx, num_layers, num_boxes):
+        pred_rel = stacked['pred_rels']
+        if pred_rel is None:
+            return {'loss_rel': stacked['pred_logits'].new_zeros(num_layers)}
+        if isinstance(pred_rel, AdaptiveRelOutput):
+            return {'loss_rel': -pred_rel.log_prob.mean(1)}
+        gt_rel = targets['rel_labels']
+        loss_rel = F.cross_entropy(pred_rel.flatten(0, 1), gt_rel.repeat(num_layers), reduction='none')
+        return {'loss_rel': loss_rel.view(num_layers, -1).mean(1)}
+
+    @torch.no_grad()
+    def _batched_loss_rel_acc(self, stacked, targets, idx, num_layers, num_boxes):
+        pred_rel = stacked['pred_rels']
+        if pred_rel is None:
+            return {'loss_rel_acc': stacked['pred_logits'].new_zeros(num_layers)}
+        if isinstance(pred_rel, AdaptiveRelOutput):
+            pred_rel = pred_rel.pred
+        else:
+            _, pred_rel = pred_rel.max(-1)
+        return {'loss_rel_acc': (pred_rel == targets['rel_labels']).float().mean(1)}
+
 
 class PostProcess(nn.Module):
     """ This module converts the model's output into the format expected by the coco api"""
@@ -543,6 +831,118 @@ class PostProcess(nn.Module):
         return boxes
 
 
+def obj_att_logits(text_feats, img_feats, batch_idx, word_idx):
+    """ Computes the object attention logits of the selected words
+    Parameters:
+        text_feats: projected word features, b * L * c
+        img_feats: projected image features, b * (h*w) * c
+        batch_idx, word_idx: indices of the selected words
+    Returns a N * (h*w) tensor, one row per selected word.
+
+    The selected word features are gathered first and scored against the features of their
+    image, which takes N instead of b * L rows of products, but gathers the image features
+    per word, a N * (h*w) * c tensor. When that is larger than the b * L * (h*w) logits of
+    all the words, i.e. unless few words are selected, a single bmm over the padded sequence
+    is used instead. Both are chosen from the shapes, without a device to host sync.
+    """
+    b, l, c = text_feats.shape
+    if len(batch_idx) * c <= b * l:
+        words = text_feats[batch_idx, word_idx]  # N * c
+        return torch.bmm(img_feats[batch_idx], words.unsqueeze(-1)).squeeze(-1)
+    logits = torch.bmm(text_feats, img_feats.transpose(1, 2))  # b * L * (h*w)
+    return logits[batch_idx, word_idx]
+
+
+class SampledLinear(nn.Linear):
+    """ Linear classifier that can score a subset of its classes
+
+    During training, the classes of a batch are its positive classes plus num_samples negatives
+    drawn with probability proportional to frequency ** 0.75, see set_frequency.
+    The full vocabulary is scored when no subset is given.
+    """
+
+    def __init__(self, in_features, out_features, num_samples=0):
+        super().__init__(in_features, out_features)
+        self.num_samples = num_samples
+        self.register_buffer('sample_weights', torch.ones(out_features), persistent=False)
+
+    def set_frequency(self, counts, power=0.75):
+        """ counts: number of training annotations of each class """
+        self.sample_weights.copy_((counts.float() + 1).pow(power))
+
+    @torch.no_grad()
+    def sample_classes(self, labels):
+        """ labels: N * out_features multi-hot targets. Returns the sorted class ids to score. """
+        positives = labels.any(0)
+        weights = self.sample_weights.masked_fill(positives, 0)
+        selected = positives.clone()
+        # multinomial without replacement needs as many non-zero weights as samples, which
+        # fails when the positives cover most of the vocabulary
+        num_samples = min(self.num_samples, int(weights.count_nonzero()))
+        if num_samples > 0:
+            negatives = torch.multinomial(weights, num_samples, replacement=False)
+            selected[negatives] = True
+        return selected.nonzero(as_tuple=True)[0]
+
+    def forward(self, x, classes=None):
+        if classes is None:
+            return super().forward(x)
+        return F.linear(x, self.weight[classes], self.bias[classes])
+
+
+class AdaptiveRelOutput(NamedTuple):
+    """ Relation predictions of the adaptive head for one decoder layer """
+    log_prob: torch.Tensor  # log-probability of the target predicate, [num_rel_pairs]
+    pred: torch.Tensor  # exact top-1 predicate, [num_rel_pairs]
+
+
+class AdaptiveRelHead(nn.Module):
+    """ Relation head with an adaptive softmax instead of a dense output layer
+
+    The predicates are ranked by training frequency (see set_frequency), the most frequent
+    ones go to the head cluster and the long tail to smaller tail clusters, so the
+    num_rel_pairs * num_classes logit matrix is never built.
+    A vocabulary too small for any cutoff gets a plain linear output layer instead.
+    """
+
+    def __init__(self, input_dim, hidden_dim, num_classes, cutoffs=None, num_layers=3):
+        super().__init__()
+        if cutoffs is None:
+            cutoffs = [max(1, num_classes // 20), max(2, num_classes // 4)]
+        cutoffs = sorted(set(c for c in cutoffs if 0 < c < num_classes))
+        self.trunk = MLP(input_dim, hidden_dim, hidden_dim, num_layers - 1)
+        if cutoffs:
+            self.asm = nn.AdaptiveLogSoftmaxWithLoss(hidden_dim, num_classes, cutoffs, div_value=4.)
+        else:
+            self.asm = None
+            self.linear = nn.Linear(hidden_dim, num_classes)
+        self.register_buffer('class_to_rank', torch.arange(num_classes))
+        self.register_buffer('rank_to_class', torch.arange(num_classes))
+
+    def set_frequency(self, counts):
+        """ counts: number of training annotations of each predicate """
+        order = counts.argsort(descending=True)
+        self.rank_to_class.copy_(order)
+        self.class_to_rank[order] = torch.arange(len(order), device=order.device)
+
+    def forward(self, x, labels):
+        """ x: D * N * input_dim pair features, labels: N target predicates
+        Returns the D * N target log-probabilities and the D * N top-1 predicates.
+        """
+        d, n, _ = x.shape
+        feats = F.relu(self.trunk(x)).flatten(0, 1)
+        target = self.class_to_rank[labels].repeat(d)
+        if self.asm is None:
+            log_probs = F.log_softmax(self.linear(feats), dim=-1)
+            log_prob = log_probs.gather(1, target[:, None]).view(d, n)
+            pred = self.rank_to_class[log_probs.detach().argmax(-1)].view(d, n)
+            return log_prob, pred
+        log_prob = self.asm(feats, target).output.view(d, n)
+        with torch.no_grad():
+            pred = self.rank_to_class[self.asm.predict(feats)].view(d, n)
+        return log_prob, pred
+
+
 class MLP(nn.Module):
     """ Very simple multi-layer perceptron (also called FFN)"""
 
@@ -589,7 +989,13 @@ def build(args):
         bert_type=args.bert_type,
         use_mlm=args.use_mlm,
         no_img=args.no_img,
-        no_obj_att=args.no_obj_att
+        no_obj_att=args.no_obj_att,
+        candidate_heads=args.candidate_heads,
+        num_attrs=args.num_attrs,
+        attr_neg_samples=args.attr_neg_samples,
+        num_rels=args.num_rels,
+        rel_head=args.rel_head,
+        rel_cutoffs=[int(c) for c in args.rel_cutoffs.split(',')] if args.rel_cutoffs else None
     )
 
     is_pretrain = args.ds_name == 'pretrain'
@@ -619,7 +1025,7 @@ def build(args):
             losses.append('mlm_acc')
             weight_dict['loss_mlm'] = args.mlm_loss_coef
         criterion = SetCriterion(num_classes, matcher=matcher, weight_dict=weight_dict,
-                                eos_coef=args.eos_coef, losses=losses)
+                                eos_coef=args.eos_coef, losses=losses, batched_aux=args.batched_aux_loss)
         postprocessors = {'bbox': PostProcess()}
     else:
         weight_dict = {
@@ -1,14 +1,34 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
 import torch
 from scipy.optimize import linear_sum_assignment
-from torch import nn
+from torch import nn, Tensor
 import torch.nn.functional as F
 
 from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
 
+class MatchIndices(NamedTuple):
+    """ Matching of a whole batch, as flat index tensors: prediction src_idx[k] of batch
+    element batch_idx[k] is matched with its target tgt_idx[k]
+    """
+    batch_idx: Tensor
+    src_idx: Tensor
+    tgt_idx: Tensor
+
+
+def pack_indices(indices, device=None):
+    """ Packs a list of per-sample (src, tgt) index pairs into a MatchIndices """
+    batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
+    src_idx = torch.cat([src for (src, _) in indices])
+    tgt_idx = torch.cat([tgt for (_, tgt) in indices])
+    return MatchIndices(batch_idx.to(device), src_idx.to(device), tgt_idx.to(device))
+
+
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -17,18 +37,22 @@ class HungarianMatcher(nn.Module):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1):
+    def __init__(self, cost_class: float = 1, cost_bbox: float = 1, cost_giou: float = 1,
+                 num_workers: int = 0):
         """Creates the matcher
 
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_bbox: This is the relative weight of the L1 error of the bounding box coordinates in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the matching cost
+            num_workers: number of threads solving the assignment problems, 0 solves them serially
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_bbox = cost_bbox
         self.cost_giou = cost_giou
+        self.num_workers = num_workers
+        self._pool = None
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
     @torch.no_grad()
@@ -46,13 +70,33 @@ class HungarianMatcher(nn.Module):
                  "boxes": Tensor of dim [num_target_boxes, 4] containing the target box coordinates
 
         Returns:
-            A list of size batch_size, containing tuples of (index_i, index_j) where:
+            A MatchIndices packing, for each batch element, the pair (index_i, index_j) where:
                 - index_i is the indices of the selected predictions (in order)
                 - index_j is the indices of the corresponding selected targets (in order)
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        return self.match_layers([outputs], targets)[0]
+
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, targets):
+        """ Matches the outputs of several decoder layers at once
+
+        The cost matrices of all layers are computed in one batch and copied to the host with a
+        single transfer, then every (layer, batch element) assignment is solved exactly with
+        scipy, in a thread pool when num_workers > 0.
+
+        Params:
+            layer_outputs: list of output dicts, see forward, one per decoder layer
+            targets: see forward
+
+        Returns:
+            A list with the matching of each layer, in the format of forward
+        """
+        num_layers = len(layer_outputs)
+        bs = layer_outputs[0]["pred_logits"].shape[0]
+        outputs = {k: torch.cat([o[k] for o in layer_outputs]) for k in ("pred_logits", "pred_boxes")}
+        num_queries = outputs["pred_logits"].shape[1]
 
         # We flatten to compute the cost matrices in a batch
         out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
@@ -77,12 +121,23 @@ class HungarianMatcher(nn.Module):
 
         # Final cost matrix
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
+        C = C.view(num_layers * bs, num_queries, -1).cpu()
 
         # sizes = [len(v["boxes"]) for v in targets]
         sizes = [1] * targets['boxes'].size(0)
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        chunks = C.split(sizes, -1)
+        costs = [chunks[i][d * bs + i] for d in range(num_layers) for i in range(bs)]
+        indices = [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
+                   for i, j in self._solve(costs)]
+        device = outputs["pred_logits"].device
+        return [pack_indices(indices[d * bs:(d + 1) * bs], device) for d in range(num_layers)]
+
+    def _solve(self, costs):
+        if self.num_workers == 0 or len(costs) < 2:
+            return [linear_sum_assignment(c) for c in costs]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.num_workers)
+        return list(self._pool.map(linear_sum_assignment, costs))
 
 
 class MaxMatcher(nn.Module):
@@ -96,8 +151,12 @@ class MaxMatcher(nn.Module):
 #       mask = (~mask).float()
 #       pred_logits = mask * pred_logits
        _, ids = pred_logits.max(1)
-       ids = ids.cpu()
-       return [(torch.as_tensor([i], dtype=torch.int64), torch.as_tensor([0], dtype=torch.int64)) for i in ids]
+       batch_idx = torch.arange(len(ids), device=ids.device)
+       return MatchIndices(batch_idx, ids, torch.zeros_like(ids))
+
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, targets):
+        return [self(outputs, targets) for outputs in layer_outputs]
 
 class FirstMatcher(nn.Module):
     """ This class return the first index as prediction
@@ -106,22 +165,34 @@ class FirstMatcher(nn.Module):
     @torch.no_grad()
     def forward(self, outputs, targets):
         bs = outputs['pred_boxes'].size(0)
-        return [(torch.as_tensor([0], dtype=torch.int64), torch.as_tensor([0], dtype=torch.int64)) for i in range(bs)]
+        batch_idx = torch.arange(bs, device=outputs['pred_boxes'].device)
+        zeros = torch.zeros_like(batch_idx)
+        return MatchIndices(batch_idx, zeros, zeros)
+
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, targets):
+        # The matching does not depend on the predictions, it is shared by all layers
+        return [self(layer_outputs[0], targets)] * len(layer_outputs)
 
 class ConstantMatcher(nn.Module):
     """ This class return self's idx
     """
     @torch.no_grad()
     def forward(self, outputs, targets):
-        bs, max_len, _ = outputs['pred_boxes'].shape
         bs, seq_len = targets['labels'].mask.shape
         mask = ~targets['labels'].mask & (targets['labels'].tensors.view(bs, seq_len) == 0)
-        ids =  torch.arange(max_len)
-        return [(ids[i], ids[i]) for i in mask]
+        batch_idx, ids = mask.nonzero(as_tuple=True)
+        return MatchIndices(batch_idx, ids, ids)
+
+    @torch.no_grad()
+    def match_layers(self, layer_outputs, targets):
+        # The matching does not depend on the predictions, it is shared by all layers
+        return [self(layer_outputs[0], targets)] * len(layer_outputs)
 
 def build_matcher(args):
     if args.matcher == 'hungarian':
-        return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou)
+        return HungarianMatcher(cost_class=args.set_cost_class, cost_bbox=args.set_cost_bbox, cost_giou=args.set_cost_giou,
+                                num_workers=args.matcher_workers)
     elif args.matcher == 'max':
         return MaxMatcher()
     elif args.matcher == 'first':
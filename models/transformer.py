@@ -53,7 +53,16 @@ class Transformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, tgt, src, img_mask, query_embed, img_embed, lang_mask):
+    def forward(self, tgt, src, img_mask, query_embed, img_embed, lang_mask,
+                return_att=False, att_layers: Optional[List[int]] = None,
+                return_intermediate: Optional[bool] = None):
+        """
+        Attention maps are only materialized when return_att is True, and only for the
+        layers listed in att_layers (all layers if None). Otherwise every attention runs
+        without weights, which lets nn.MultiheadAttention use fused scaled-dot-product attention.
+        return_intermediate overrides the decoder setting for this call, hs then only holds
+        the last layer when it is False.
+        """
         has_img = (src is not None)
         if has_img:
             # Reshape NxCxHxW to HWxNxC
@@ -65,8 +74,8 @@ class Transformer(nn.Module):
         query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)
         tgt = tgt.transpose(0, 1).contiguous()
 
-        tgt = self.lang_encoder(tgt, src_key_padding_mask=lang_mask, pos=query_embed) \
-            if self.lang_encoder is not None else tgt
+        if self.lang_encoder is not None:
+            tgt, _ = self.lang_encoder(tgt, src_key_padding_mask=lang_mask, pos=query_embed)
         # Encode image feature or cross-modal feature
         # Cross modal
         if self.cross_encoder:
@@ -83,7 +92,14 @@ class Transformer(nn.Module):
             # Image only
             mask = img_mask
             pos = img_embed
-        memory, attn_maps = self.encoder(src, src_key_padding_mask=mask, pos=pos)
+        # Only the pretraining branch reads encoder attention, and only its text-to-image block
+        enc_att_layers = None
+        enc_att_slice = None
+        if return_att and self.is_pretrain and has_img:
+            enc_att_layers = att_layers if att_layers is not None else range(self.encoder.num_layers)
+            enc_att_slice = (slice(h*w, None), slice(0, h*w))
+        memory, attn_maps = self.encoder(src, src_key_padding_mask=mask, pos=pos,
+                                         att_layers=enc_att_layers, att_slice=enc_att_slice)
         if self.cross_encoder:
             if has_img:
                 # Use alined image and language feature
@@ -92,8 +108,12 @@ class Transformer(nn.Module):
             else:
                 tgt = memory
         if not self.is_pretrain:
+            dec_att_layers = None
+            if return_att:
+                dec_att_layers = att_layers if att_layers is not None else range(self.decoder.num_layers)
             hs, self_att, cross_att = self.decoder(tgt, memory, memory_key_padding_mask=img_mask,
-                            tgt_key_padding_mask=lang_mask, pos=img_embed, query_pos=query_embed)
+                            tgt_key_padding_mask=lang_mask, pos=img_embed, query_pos=query_embed,
+                            att_layers=dec_att_layers, return_intermediate=return_intermediate)
 
             visual_dict = {
                 'hs': hs.transpose(1, 2),
@@ -111,10 +131,9 @@ class Transformer(nn.Module):
                 'cross_lang': tgt.permute(1, 0, 2).view(bs, -1, c)
             }
             if has_img:
-                cross_att = attn_maps[:, :, h*w:, 0:h*w]
-                N, B, L, S = cross_att.shape  # N is the number of layers
-                cross_att = cross_att.view(N, B, L, h, w)
-                visual_dict['cross_att'] = cross_att
+                if attn_maps is not None:
+                    N, B, L, S = attn_maps.shape  # N is the number of layers
+                    visual_dict['cross_att'] = attn_maps.view(N, B, L, h, w)
                 return  visual_dict, memory.permute(1, 2, 0).view(bs, c, h, w)
             return visual_dict, None
             
@@ -131,19 +150,33 @@ class TransformerEncoder(nn.Module):
     def forward(self, src,
                 mask: Optional[Tensor] = None,
                 src_key_padding_mask: Optional[Tensor] = None,
-                pos: Optional[Tensor] = None):
+                pos: Optional[Tensor] = None,
+                att_layers: Optional[List[int]] = None,
+                att_slice: Optional[tuple] = None):
+        """
+        Returns the encoded output and the stacked attention maps of the layers in att_layers,
+        cut to att_slice (query slice, key slice) before stacking. The maps are None when no
+        layer is requested.
+        """
         output = src
         attn_maps = []
 
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
+            need_weights = att_layers is not None and i in att_layers
             output, attn = layer(output, src_mask=mask,
-                           src_key_padding_mask=src_key_padding_mask, pos=pos)
-            attn_maps.append(attn)
+                           src_key_padding_mask=src_key_padding_mask, pos=pos,
+                           need_weights=need_weights)
+            if need_weights:
+                if att_slice is not None:
+                    # copy the slice so the full (B, S, S) map can be freed right away
+                    attn = attn[(slice(None),) + tuple(att_slice)].contiguous()
+                attn_maps.append(attn)
 
         if self.norm is not None:
             output = self.norm(output)
 
-        return output, torch.stack(attn_maps, dim=0)
+        attn_maps = torch.stack(attn_maps, dim=0) if attn_maps else None
+        return output, attn_maps
 
 
 class TransformerDecoder(nn.Module):
@@ -161,34 +194,47 @@ class TransformerDecoder(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                att_layers: Optional[List[int]] = None,
+                return_intermediate: Optional[bool] = None):
+        """
+        Attention maps are collected for the layers in att_layers only, and returned as
+        None when no layer is requested. return_intermediate defaults to the value given
+        at construction, when False only the normalized last layer is returned.
+        """
+        if return_intermediate is None:
+            return_intermediate = self.return_intermediate
         output = tgt
 
         intermediate = []
         inter_self_att = []
         inter_cross_att = []
 
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
+            need_weights = att_layers is not None and i in att_layers
             output, self_att, cross_att = layer(output, memory, tgt_mask=tgt_mask,
                            memory_mask=memory_mask,
                            tgt_key_padding_mask=tgt_key_padding_mask,
                            memory_key_padding_mask=memory_key_padding_mask,
-                           pos=pos, query_pos=query_pos)
-            if self.return_intermediate:
+                           pos=pos, query_pos=query_pos, need_weights=need_weights)
+            # the last layer is normalized once below
+            if return_intermediate and i < len(self.layers) - 1:
                 intermediate.append(self.norm(output))
+            if need_weights:
                 inter_self_att.append(self_att)
                 inter_cross_att.append(cross_att)
 
         if self.norm is not None:
             output = self.norm(output)
-            if self.return_intermediate:
-                intermediate.pop()
-                intermediate.append(output)
+        if return_intermediate:
+            intermediate.append(output)
 
-        if self.return_intermediate:
-            return torch.stack(intermediate), torch.stack(inter_self_att), torch.stack(inter_cross_att)
+        self_att = torch.stack(inter_self_att) if inter_self_att else None
+        cross_att = torch.stack(inter_cross_att) if inter_cross_att else None
+        if return_intermediate:
+            return torch.stack(intermediate), self_att, cross_att
 
-        return output.unsqueeze(0), self_att.unsqueeze(0), cross_att.unsqueeze(0)
+        return output.unsqueeze(0), self_att, cross_att
 
 
 class TransformerEncoderLayer(nn.Module):
@@ -217,10 +263,11 @@ class TransformerEncoderLayer(nn.Module):
                      src,
                      src_mask: Optional[Tensor] = None,
                      src_key_padding_mask: Optional[Tensor] = None,
-                     pos: Optional[Tensor] = None):
+                     pos: Optional[Tensor] = None,
+                     need_weights: bool = False):
         q = k = self.with_pos_embed(src, pos)
         src2, attn = self.self_attn(q, k, value=src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)
+                              key_padding_mask=src_key_padding_mask, need_weights=need_weights)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
@@ -231,11 +278,12 @@ class TransformerEncoderLayer(nn.Module):
     def forward_pre(self, src,
                     src_mask: Optional[Tensor] = None,
                     src_key_padding_mask: Optional[Tensor] = None,
-                    pos: Optional[Tensor] = None):
+                    pos: Optional[Tensor] = None,
+                    need_weights: bool = False):
         src2 = self.norm1(src)
         q = k = self.with_pos_embed(src2, pos)
         src2, attn = self.self_attn(q, k, value=src2, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)
+                              key_padding_mask=src_key_padding_mask, need_weights=need_weights)
         src = src + self.dropout1(src2)
         src2 = self.norm2(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src2))))
@@ -245,10 +293,11 @@ class TransformerEncoderLayer(nn.Module):
     def forward(self, src,
                 src_mask: Optional[Tensor] = None,
                 src_key_padding_mask: Optional[Tensor] = None,
-                pos: Optional[Tensor] = None):
+                pos: Optional[Tensor] = None,
+                need_weights: bool = False):
         if self.normalize_before:
-            return self.forward_pre(src, src_mask, src_key_padding_mask, pos)
-        return self.forward_post(src, src_mask, src_key_padding_mask, pos)
+            return self.forward_pre(src, src_mask, src_key_padding_mask, pos, need_weights)
+        return self.forward_post(src, src_mask, src_key_padding_mask, pos, need_weights)
 
 
 class TransformerDecoderLayer(nn.Module):
@@ -282,16 +331,18 @@ class TransformerDecoderLayer(nn.Module):
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
-                     query_pos: Optional[Tensor] = None):
+                     query_pos: Optional[Tensor] = None,
+                     need_weights: bool = False):
         q = k = self.with_pos_embed(tgt, query_pos)
         tgt2, self_att = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)
+                              key_padding_mask=tgt_key_padding_mask, need_weights=need_weights)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
         tgt2, cross_att = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
                                    key=self.with_pos_embed(memory, pos),
                                    value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)
+                                   key_padding_mask=memory_key_padding_mask,
+                                   need_weights=need_weights)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
@@ -305,17 +356,19 @@ class TransformerDecoderLayer(nn.Module):
                     tgt_key_padding_mask: Optional[Tensor] = None,
                     memory_key_padding_mask: Optional[Tensor] = None,
                     pos: Optional[Tensor] = None,
-                    query_pos: Optional[Tensor] = None):
+                    query_pos: Optional[Tensor] = None,
+                    need_weights: bool = False):
         tgt2 = self.norm1(tgt)
         q = k = self.with_pos_embed(tgt2, query_pos)
         tgt2, self_att = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)
+                              key_padding_mask=tgt_key_padding_mask, need_weights=need_weights)
         tgt = tgt + self.dropout1(tgt2)
         tgt2 = self.norm2(tgt)
         tgt2, cross_att = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
                                    key=self.with_pos_embed(memory, pos),
                                    value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)
+                                   key_padding_mask=memory_key_padding_mask,
+                                   need_weights=need_weights)
         tgt = tgt + self.dropout2(tgt2)
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
@@ -328,12 +381,15 @@ class TransformerDecoderLayer(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                need_weights: bool = False):
         if self.normalize_before:
             return self.forward_pre(tgt, memory, tgt_mask, memory_mask,
-                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos,
+                                    need_weights)
         return self.forward_post(tgt, memory, tgt_mask, memory_mask,
-                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos,
+                                 need_weights)
 
 
 class FeatureResizer(nn.Module):
@@ -0,0 +1,69 @@
+import unittest
+
+import torch
+
+from util.box_ops import box_iou, generalized_box_iou, paired_box_iou, paired_generalized_box_iou
+from util.misc import IoU_values, paired_IoU_values
+
+
+def random_boxes(n, seed=0):
+    """ Valid x0 y0 x1 y1 boxes, with zero-area and identical pairs mixed in """
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand(n, 2, generator=g) * 100
+    wh = torch.rand(n, 2, generator=g) * 50
+    boxes1 = torch.cat([xy, xy + wh], 1)
+    boxes2 = boxes1 + torch.randn(n, 4, generator=g) * 10
+    boxes2 = torch.cat([boxes2[:, :2], torch.max(boxes2[:, :2], boxes2[:, 2:])], 1)
+    # zero width, zero height and point boxes
+    boxes1[0, 2] = boxes1[0, 0]
+    boxes2[1, 3] = boxes2[1, 1]
+    boxes1[2, 2:] = boxes1[2, :2]
+    boxes2[2] = boxes1[2]
+    # identical boxes and disjoint boxes
+    boxes2[3] = boxes1[3]
+    boxes2[4] = boxes1[4] + 200
+    return boxes1, boxes2
+
+
+class PairedBoxOpsTest(unittest.TestCase):
+    def assert_same(self, a, b):
+        torch.testing.assert_close(a, b, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+    def test_paired_box_iou(self):
+        for seed in range(3):
+            boxes1, boxes2 = random_boxes(64, seed)
+            iou, union = paired_box_iou(boxes1, boxes2)
+            full_iou, full_union = box_iou(boxes1, boxes2)
+            self.assert_same(iou, full_iou.diag())
+            self.assert_same(union, full_union.diag())
+
+    def test_paired_generalized_box_iou(self):
+        for seed in range(3):
+            boxes1, boxes2 = random_boxes(64, seed)
+            self.assert_same(paired_generalized_box_iou(boxes1, boxes2),
+                             generalized_box_iou(boxes1, boxes2).diag())
+
+    def test_paired_iou_values(self):
+        for seed in range(3):
+            boxes1, boxes2 = random_boxes(64, seed)
+            self.assert_same(paired_IoU_values(boxes1, boxes2), IoU_values(boxes1, boxes2).diag())
+
+    def test_degenerate_boxes(self):
+        # a point box against itself has a zero union, the IoU is NaN as in the pairwise version
+        boxes = torch.tensor([[5., 5., 5., 5.]])
+        self.assertTrue(paired_box_iou(boxes, boxes)[0].isnan().all())
+        self.assert_same(paired_box_iou(boxes, boxes)[0], box_iou(boxes, boxes)[0].diag())
+        # inverted boxes are rejected by the GIoU
+        inverted = torch.tensor([[10., 10., 0., 0.]])
+        with self.assertRaises(AssertionError):
+            paired_generalized_box_iou(inverted, boxes)
+
+    def test_empty(self):
+        empty = torch.zeros(0, 4)
+        self.assertEqual(paired_box_iou(empty, empty)[0].shape, (0,))
+        self.assertEqual(paired_generalized_box_iou(empty, empty).shape, (0,))
+        self.assertEqual(paired_IoU_values(empty, empty).shape, (0,))
+
+
+if __name__ == '__main__':
+    unittest.main()
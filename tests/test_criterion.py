@@ -0,0 +1,94 @@
+import unittest
+
+import torch
+
+from models.detr import DETR, AdaptiveRelOutput, SetCriterion, obj_att_logits
+from models.matcher import ConstantMatcher
+from util.misc import NestedTensor
+
+LOSSES = ['labels', 'boxes', 'accuracy', 'attr', 'rel', 'rel_acc']
+
+
+def random_batch(num_layers=6, bs=4, seq_len=12, num_rel_pairs=10, num_attrs=50, num_rels=30,
+                 adaptive_rel=False, seed=0):
+    """ Model outputs of every decoder layer and the matching targets """
+    g = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(seq_len // 2, seq_len + 1, (bs,), generator=g)
+    mask = torch.arange(seq_len)[None] >= lengths[:, None]
+    labels = torch.randint(2, (bs, seq_len, 1), generator=g)
+    cthw = torch.rand(bs, seq_len, 4, generator=g) * 0.5 + 0.25
+    targets = {
+        'labels': NestedTensor(labels, mask),
+        'cthw': NestedTensor(cthw, mask),
+        'orig_size': torch.randint(200, 600, (bs, 2), generator=g).float(),
+        'attr_labels': (torch.rand(num_rel_pairs, num_attrs, generator=g) < 0.1).float(),
+        'rel_labels': torch.randint(num_rels, (num_rel_pairs,), generator=g),
+        'idxs': torch.arange(bs),
+    }
+    outputs_class = torch.randn(num_layers, bs, seq_len, 2, generator=g).requires_grad_()
+    outputs_coord = (torch.rand(num_layers, bs, seq_len, 4, generator=g) * 0.5 + 0.25).requires_grad_()
+    outputs_attr = torch.randn(num_layers, num_rel_pairs, num_attrs, generator=g).requires_grad_()
+    if adaptive_rel:
+        log_prob = -torch.rand(num_layers, num_rel_pairs, generator=g).requires_grad_()
+        pred = torch.randint(num_rels, (num_layers, num_rel_pairs), generator=g)
+        outputs_rel = [AdaptiveRelOutput(lp, p) for lp, p in zip(log_prob, pred)]
+        leaves = [outputs_class, outputs_coord, outputs_attr, log_prob]
+    else:
+        outputs_rel = torch.randn(num_layers, num_rel_pairs, num_rels, generator=g).requires_grad_()
+        leaves = [outputs_class, outputs_coord, outputs_attr, outputs_rel]
+    outputs = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1],
+               'pred_attrs': outputs_attr[-1], 'pred_rels': outputs_rel[-1],
+               # the model methods do not use self
+               'aux_outputs': DETR._set_aux_loss(None, outputs_class, outputs_coord, outputs_attr, outputs_rel),
+               'aux_stacked': DETR._stack_aux_loss(None, outputs_class, outputs_coord, outputs_attr, outputs_rel)}
+    return outputs, targets, leaves
+
+
+def build_criterion(batched_aux):
+    weight_dict = {'loss_ce': 1, 'loss_bbox': 5, 'loss_giou': 2, 'loss_attr': 1, 'loss_rel': 1}
+    weight_dict.update({k + f'_{i}': v for i in range(5) for k, v in list(weight_dict.items())})
+    return SetCriterion(1, ConstantMatcher(), weight_dict, eos_coef=0.1, losses=LOSSES,
+                        batched_aux=batched_aux)
+
+
+class BatchedAuxLossTest(unittest.TestCase):
+    def _check(self, adaptive_rel):
+        results = []
+        for batched_aux in (False, True):
+            outputs, targets, leaves = random_batch(adaptive_rel=adaptive_rel)
+            criterion = build_criterion(batched_aux)
+            losses = criterion(outputs, targets)
+            total = sum(losses[k] * criterion.weight_dict[k] for k in losses if k in criterion.weight_dict)
+            grads = torch.autograd.grad(total, leaves)
+            results.append((losses, grads))
+        (loop, loop_grads), (batched, batched_grads) = results
+        self.assertEqual(sorted(loop), sorted(batched))
+        for k in loop:
+            self.assertTrue(torch.allclose(loop[k], batched[k], rtol=1e-5, atol=1e-6), k)
+        for a, b in zip(loop_grads, batched_grads):
+            self.assertTrue(torch.allclose(a, b, rtol=1e-5, atol=1e-6))
+
+    def test_dense_rel_head(self):
+        self._check(adaptive_rel=False)
+
+    def test_adaptive_rel_head(self):
+        self._check(adaptive_rel=True)
+
+
+
+class ObjAttLogitsTest(unittest.TestCase):
+    def test_gather_matches_dense(self):
+        g = torch.Generator().manual_seed(0)
+        text = torch.randn(3, 10, 4, generator=g)
+        img = torch.randn(3, 15, 4, generator=g)
+        dense = torch.bmm(text, img.transpose(1, 2))
+        # few words take the gather path, many the dense bmm
+        for n in (5, 20):
+            batch_idx = torch.randint(3, (n,), generator=g)
+            word_idx = torch.randint(10, (n,), generator=g)
+            logits = obj_att_logits(text, img, batch_idx, word_idx)
+            self.assertTrue(torch.allclose(logits, dense[batch_idx, word_idx], rtol=1e-5, atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from models.matcher import HungarianMatcher
+from util.box_ops import box_cxcywh_to_xyxy, generalized_box_iou
+
+
+def random_batch(num_layers, bs, num_queries, num_classes=2, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    layer_outputs = [{
+        'pred_logits': torch.randn(bs, num_queries, num_classes, generator=g),
+        'pred_boxes': torch.rand(bs, num_queries, 4, generator=g) * 0.5 + 0.25,
+    } for _ in range(num_layers)]
+    targets = {
+        'labels': torch.randint(num_classes, (bs, 1), generator=g),
+        'boxes': torch.rand(bs, 4, generator=g) * 0.5 + 0.25,
+    }
+    return layer_outputs, targets
+
+
+def reference_match(matcher, outputs, targets):
+    """ Per-sample cost matrices solved with scipy, without any batching """
+    matches = []
+    for i in range(outputs['pred_logits'].shape[0]):
+        prob = outputs['pred_logits'][i].softmax(-1)
+        out_bbox = outputs['pred_boxes'][i]
+        tgt_bbox = targets['boxes'][i:i + 1]
+        cost = matcher.cost_class * -prob[:, targets['labels'][i]] \
+            + matcher.cost_bbox * torch.cdist(out_bbox, tgt_bbox, p=1) \
+            + matcher.cost_giou * -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+        src, tgt = linear_sum_assignment(cost.numpy())
+        matches.append((i, src.tolist(), tgt.tolist()))
+    return matches
+
+
+def unpack(indices):
+    return list(zip(indices.batch_idx.tolist(), indices.src_idx.tolist(), indices.tgt_idx.tolist()))
+
+
+class HungarianMatcherTest(unittest.TestCase):
+    def test_match_layers_equals_forward(self):
+        for num_workers in (0, 4):
+            matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_workers=num_workers)
+            for seed in range(5):
+                layer_outputs, targets = random_batch(num_layers=6, bs=8, num_queries=20, seed=seed)
+                batched = matcher.match_layers(layer_outputs, targets)
+                self.assertEqual(len(batched), len(layer_outputs))
+                for outputs, indices in zip(layer_outputs, batched):
+                    expected = matcher(outputs, targets)
+                    for a, b in zip(indices, expected):
+                        self.assertTrue(torch.equal(a, b))
+
+    def test_against_scipy(self):
+        # randomized corpus of batch shapes, compared with a per-sample scipy solve
+        g = torch.Generator().manual_seed(0)
+        for seed in range(20):
+            num_layers, bs, num_queries = [int(v) for v in torch.randint(1, 12, (3,), generator=g)]
+            layer_outputs, targets = random_batch(num_layers, bs, num_queries, seed=seed)
+            for num_workers in (0, 3):
+                matcher = HungarianMatcher(cost_class=1, cost_bbox=5, cost_giou=2, num_workers=num_workers)
+                for outputs, indices in zip(layer_outputs, matcher.match_layers(layer_outputs, targets)):
+                    got = unpack(indices)
+                    expected = [(i, s, t) for i, src, tgt in reference_match(matcher, outputs, targets)
+                                for s, t in zip(src, tgt)]
+                    self.assertEqual(got, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
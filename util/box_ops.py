@@ -64,6 +64,52 @@ def generalized_box_iou(boxes1, boxes2):
     return iou - (area - union) / area
 
 
+def paired_box_iou(boxes1, boxes2):
+    """
+    IoU of each box of boxes1 with the box of boxes2 in the same row,
+    the diagonal of box_iou computed in O(N) memory. Also returns the union.
+
+    The boxes should be in [x0, y0, x1, y1] format, both [N, 4]
+    """
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])  # [N,2]
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])  # [N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    inter = wh[:, 0] * wh[:, 1]  # [N]
+
+    union = area1 + area2 - inter
+
+    iou = inter / union
+    return iou, union
+
+
+def paired_generalized_box_iou(boxes1, boxes2):
+    """
+    Generalized IoU of each box of boxes1 with the box of boxes2 in the same row,
+    the diagonal of generalized_box_iou computed in O(N) memory.
+
+    The boxes should be in [x0, y0, x1, y1] format, both [N, 4]
+
+    Returns a [N] tensor
+    """
+    # degenerate boxes gives inf / nan results
+    # so do an early check
+    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
+    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    iou, union = paired_box_iou(boxes1, boxes2)
+
+    lt = torch.min(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.max(boxes1[:, 2:], boxes2[:, 2:])
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    area = wh[:, 0] * wh[:, 1]
+
+    return iou - (area - union) / area
+
+
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
 
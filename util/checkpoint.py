@@ -0,0 +1,210 @@
+"""
+Checkpoint writing off the training loop.
+"""
+import json
+import os
+import os.path as osp
+import threading
+
+import torch
+
+from util.misc import is_main_process
+
+
+def to_host(obj):
+    """ Copy of a (nested) state dict with every tensor copied to host memory """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v) for v in obj)
+    return obj
+
+
+def slim_state_dict(model):
+    """ state_dict of model without the frozen tensors of its pretrained submodules
+    (model.pretrained_sources()), which are rebuilt from the pretrained files when the
+    model is constructed. Returns the state dict and the manifest of the left out tensors.
+    """
+    sources = model.pretrained_sources() if hasattr(model, 'pretrained_sources') else {}
+    trainable = {n for n, p in model.named_parameters() if p.requires_grad}
+    state = model.state_dict()
+    frozen = [k for k in state if k.startswith(tuple(sources)) and k not in trainable]
+    for k in frozen:
+        del state[k]
+    return state, {'sources': sources, 'keys': frozen}
+
+
+def load_checkpoint(path):
+    """ torch.load on the host, memory-mapped when this torch version supports it.
+    The checkpoints pickle the args namespace, so they are not loaded with weights_only,
+    the default of torch >= 2.6.
+    """
+    if path.startswith('https'):
+        return torch.hub.load_state_dict_from_url(path, map_location='cpu', check_hash=True)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:
+        # torch without mmap, nor weights_only before 1.13, which then loads everything
+        return torch.load(path, map_location='cpu')
+    except RuntimeError:
+        # a checkpoint in the legacy format, which cannot be memory-mapped
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def load_model_state(model, checkpoint):
+    """ Loads checkpoint['model'] into model, the tensors left out of a slim checkpoint
+    keep the pretrained values model was built with
+    """
+    missing, unexpected = model.load_state_dict(checkpoint['model'], strict=False)
+    manifest = checkpoint.get('frozen')
+    if manifest is not None:
+        sources = model.pretrained_sources() if hasattr(model, 'pretrained_sources') else {}
+        if sources != manifest['sources']:
+            print('Warning: checkpoint frozen weights from {}, model built from {}'.format(
+                manifest['sources'], sources))
+        frozen = set(manifest['keys'])
+        missing = [k for k in missing if k not in frozen]
+    if missing:
+        print('Missing keys in checkpoint:', missing)
+    if unexpected:
+        print('Unexpected keys in checkpoint:', unexpected)
+
+
+def atomic_save(state, path):
+    """ torch.save through a temporary file renamed over path, a crash never leaves a partial file """
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """
+    Writes checkpoint.pth and the per-epoch checkpoint{epoch:04}.pth of the main process.
+
+    save() snapshots the state to host memory and returns, the file is written by a
+    background thread, atomically. The per-epoch file is a hardlink of checkpoint.pth,
+    not a second serialization. Only the last keep_last epochs plus the keep_best best
+    epochs by metric are kept, the history is in checkpoints.json. An epoch saved without
+    its metric only counts for recency, unless the metric is pending: it is then kept until
+    set_metric gives it, e.g. from an evaluator process.
+    A save waits for the previous write, so at most one snapshot is in memory. An error of
+    the writer thread is raised again by the next save, wait or close.
+    """
+
+    def __init__(self, output_dir, keep_last=5, keep_best=1, metric='accuracy', mode='max'):
+        assert mode in ('max', 'min')
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self.history_file = osp.join(output_dir, 'checkpoints.json')
+        self.history = []
+        if osp.exists(self.history_file):
+            with open(self.history_file, 'r') as f:
+                self.history = json.load(f)
+        self._thread = None
+        self._error = None
+        # the history is also updated by set_metric, from the training thread
+        self._lock = threading.Lock()
+
+    def save(self, state, epoch=None, stats=None, on_saved=None, pending_metric=False):
+        """ state: the checkpoint dict, stats: the epoch stats holding the metric, only
+        the stats of a full evaluation should be given.
+        Without epoch, e.g. for a step checkpoint, only checkpoint.pth is written.
+        on_saved(path) is called by the writer thread once the per-epoch file is written.
+        pending_metric: the metric is given later by set_metric.
+        """
+        if not is_main_process():
+            return
+        self.wait()
+        state = to_host(state)
+        value = None
+        if stats is not None and self.metric in stats:
+            value = float(stats[self.metric])
+        self._thread = threading.Thread(target=self._run, args=(state, epoch, value, on_saved,
+                                                                pending_metric and value is None))
+        self._thread.start()
+
+    def set_metric(self, epoch, stats):
+        """ Metric of an epoch saved with pending_metric, from its evaluation stats """
+        if not is_main_process():
+            return
+        value = None
+        if stats is not None and self.metric in stats:
+            value = float(stats[self.metric])
+        with self._lock:
+            for h in self.history:
+                if h['epoch'] == epoch:
+                    h[self.metric] = value
+                    h.pop('pending', None)
+            self._prune()
+            self._write_history()
+
+    def wait(self):
+        """ Blocks until the pending checkpoint is written, raises the error of its writer """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the checkpoint failed") from error
+
+    close = wait
+
+    def epoch_path(self, epoch):
+        return osp.join(self.output_dir, f'checkpoint{epoch:04}.pth')
+
+    def _run(self, *args):
+        # e.g. a full disk or a pickling error, kept for the training thread
+        try:
+            self._write(*args)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, state, epoch, value, on_saved=None, pending=False):
+        last_path = osp.join(self.output_dir, 'checkpoint.pth')
+        atomic_save(state, last_path)
+        if epoch is None:
+            return
+        epoch_path = self.epoch_path(epoch)
+        tmp_path = epoch_path + '.tmp'
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(last_path, tmp_path)
+        except OSError:
+            # no hardlinks on this filesystem
+            atomic_save(state, epoch_path)
+        else:
+            os.replace(tmp_path, epoch_path)
+
+        with self._lock:
+            self.history = [h for h in self.history if h['epoch'] != epoch]
+            entry = {'epoch': epoch, self.metric: value}
+            if pending:
+                entry['pending'] = True
+            self.history.append(entry)
+            self._prune()
+            self._write_history()
+        if on_saved is not None:
+            on_saved(epoch_path)
+
+    def _write_history(self):
+        with open(self.history_file + '.tmp', 'w') as f:
+            json.dump(self.history, f)
+        os.replace(self.history_file + '.tmp', self.history_file)
+
+    def _prune(self):
+        epochs = sorted(h['epoch'] for h in self.history)
+        keep = set(epochs[-self.keep_last:]) if self.keep_last > 0 else set()
+        keep.update(h['epoch'] for h in self.history if h.get('pending'))
+        scored = [h for h in self.history if h.get(self.metric) is not None]
+        scored.sort(key=lambda h: h[self.metric], reverse=self.mode == 'max')
+        keep.update(h['epoch'] for h in scored[:self.keep_best])
+        for h in self.history:
+            if h['epoch'] not in keep and osp.exists(self.epoch_path(h['epoch'])):
+                os.remove(self.epoch_path(h['epoch']))
+        self.history = [h for h in self.history if h['epoch'] in keep]
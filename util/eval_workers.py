@@ -0,0 +1,94 @@
+"""
+Evaluation of the training checkpoints by separate processes.
+"""
+import json
+import os
+import os.path as osp
+import subprocess
+import sys
+import threading
+
+# launcher variables that would make an evaluator join the training process group
+DIST_ENV = ('RANK', 'WORLD_SIZE', 'LOCAL_RANK', 'MASTER_ADDR', 'MASTER_PORT', 'SLURM_PROCID')
+
+
+class EvaluatorPool(object):
+    """
+    Runs `main.py --eval --resume <checkpoint>` with the training command line in up to
+    num_workers local processes, the evaluators append their test stats to log.txt
+    (--eval_log_epoch) and write their other files to output_dir/eval{epoch:04} (--eval_dir).
+
+    submit() never waits: the checkpoints are queued, and an evaluator is started for
+    the next one as soon as a worker is free, at the next submit() or poll().
+    device: the only device the evaluators see, e.g. 'cuda:3' or 'cpu', they share the
+    GPU of the first training process otherwise.
+    """
+
+    def __init__(self, num_workers=1, device=None, argv=None, output_dir=''):
+        self.num_workers = max(num_workers, 1)
+        self.argv = list(sys.argv if argv is None else argv)
+        self.device = device
+        self.output_dir = output_dir
+        self.queue = []
+        self.procs = []  # (process, epoch)
+        # submit is called by the checkpoint writer thread, poll by the training loop
+        self._lock = threading.Lock()
+
+    def submit(self, checkpoint_path, epoch):
+        with self._lock:
+            self.queue.append((checkpoint_path, epoch))
+        self.poll()
+
+    def poll(self):
+        """ Starts the queued evaluations that have a free worker.
+        Returns the (epoch, stats) of the evaluations finished since the last call,
+        stats is None when the evaluator failed.
+        """
+        with self._lock:
+            finished = [(p, epoch) for p, epoch in self.procs if p.poll() is not None]
+            self.procs = [(p, epoch) for p, epoch in self.procs if p.poll() is None]
+            while self.queue and len(self.procs) < self.num_workers:
+                checkpoint_path, epoch = self.queue.pop(0)
+                self.procs.append((self._start(checkpoint_path, epoch), epoch))
+        return [(epoch, self._read_stats(p, epoch)) for p, epoch in finished]
+
+    def close(self):
+        """ Waits for the running and queued evaluators, returns their results, see poll """
+        results = []
+        while True:
+            results += self.poll()
+            with self._lock:
+                if not self.procs and not self.queue:
+                    return results
+                p = self.procs[0][0] if self.procs else None
+            if p is not None:
+                p.wait()
+
+    def eval_dir(self, epoch):
+        return f'eval{epoch:04}'
+
+    def _start(self, checkpoint_path, epoch):
+        # the last occurrence of an option wins, so the overrides are appended
+        cmd = [sys.executable] + self.argv + ['--eval', '--eval_schedule', 'epoch', '--resume', checkpoint_path,
+                                              '--eval_log_epoch', str(epoch), '--eval_dir', self.eval_dir(epoch)]
+        env = {k: v for k, v in os.environ.items() if k not in DIST_ENV}
+        if self.device is not None:
+            if self.device == 'cpu':
+                env['CUDA_VISIBLE_DEVICES'] = ''
+                cmd += ['--device', 'cpu']
+            else:
+                # e.g. cuda:3, the evaluator only sees that GPU, as its cuda:0
+                index = int(self.device.split(':')[1]) if ':' in self.device else 0
+                visible = env.get('CUDA_VISIBLE_DEVICES')
+                env['CUDA_VISIBLE_DEVICES'] = visible.split(',')[index] if visible else str(index)
+                cmd += ['--device', 'cuda']
+        print("Evaluating {} in the background".format(checkpoint_path))
+        return subprocess.Popen(cmd, env=env)
+
+    def _read_stats(self, p, epoch):
+        stats_file = osp.join(self.output_dir, self.eval_dir(epoch), 'stats.json')
+        if p.returncode != 0 or not osp.exists(stats_file):
+            print("Evaluation of epoch {} failed".format(epoch))
+            return None
+        with open(stats_file, 'r') as f:
+            return json.load(f)
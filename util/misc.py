@@ -4,6 +4,7 @@ Misc functions, including distributed helpers.
 Mostly copy-paste from torchvision references.
 """
 import os
+import random
 import subprocess
 import time
 from collections import defaultdict, deque
@@ -11,6 +12,7 @@ import datetime
 import pickle
 from typing import Optional, List
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch import Tensor
@@ -84,6 +86,97 @@ class SmoothedValue(object):
             value=self.value)
 
 
+class IoUMeter(object):
+    """Accumulate grounding IoUs in a fixed-bin histogram kept on the device,
+    so the memory does not grow with the number of evaluated samples.
+    Accuracies at bin edges and the mean IoU are exact, quantiles are
+    resolved to the bin width.
+    """
+
+    def __init__(self, num_bins=1000, thresholds=(0.5, 0.75), quantiles=(0.25, 0.5, 0.75)):
+        self.num_bins = num_bins
+        self.thresholds = thresholds
+        self.quantiles = quantiles
+        self.reset()
+
+    def reset(self):
+        self.hist = None
+        self.total = None
+        self.nan_count = None
+
+    def update(self, ious):
+        ious = ious.detach().flatten()
+        if self.hist is None:
+            self.hist = torch.zeros(self.num_bins, dtype=torch.float64, device=ious.device)
+            self.total = torch.zeros((), dtype=torch.float64, device=ious.device)
+            self.nan_count = torch.zeros((), dtype=torch.float64, device=ious.device)
+        elif self.hist.device != ious.device:
+            # loaded from a state dict
+            self.hist, self.total, self.nan_count = (t.to(ious.device) for t in
+                                                     (self.hist, self.total, self.nan_count))
+        # no boolean indexing nor bincount, whose output sizes need a host sync: the NaN IoUs
+        # are added to bin 0 with a zero weight
+        nan = torch.isnan(ious)
+        self.nan_count += nan.sum()
+        ious = torch.nan_to_num(ious, nan=0.).clamp(0, 1)
+        bins = (ious * self.num_bins).long().clamp(max=self.num_bins - 1)
+        self.hist.index_add_(0, bins, (~nan).to(torch.float64))
+        self.total += ious.sum(dtype=torch.float64)
+
+    def synchronize_between_processes(self):
+        if not is_dist_avail_and_initialized():
+            return
+        if self.hist is None:
+            # this rank saw no sample, it still takes part in the reduction
+            self.update(torch.zeros(0, device='cuda'))
+        t = torch.cat([self.hist, self.total.view(1), self.nan_count.view(1)]).cuda()
+        dist.all_reduce(t)
+        self.hist, self.total, self.nan_count = t[:-2], t[-2], t[-1]
+
+    @property
+    def count(self):
+        # the NaN IoUs included, as in summary
+        return 0 if self.hist is None else int(self.hist.sum().item() + self.nan_count.item())
+
+    def summary(self):
+        """Acc@threshold, mean IoU, IoU quantiles and the number of NaN IoUs. As in the criterion
+        accuracy and the GroundingEvaluator, a NaN IoU counts as an IoU of 0, i.e. as a miss.
+        """
+        if self.hist is None:
+            return {}
+        # copied, cpu() does not copy a host histogram
+        hist = self.hist.cpu().clone()
+        hist[0] += self.nan_count.item()
+        count = max(hist.sum().item(), 1)
+        stats = {}
+        for t in self.thresholds:
+            stats['Acc@{:g}'.format(t)] = hist[int(round(t * self.num_bins)):].sum().item() / count
+        stats['mIoU'] = self.total.item() / count
+        cdf = hist.cumsum(0) / count
+        for q in self.quantiles:
+            # upper edge of the first bin reaching the quantile
+            stats['IoU@q{:g}'.format(q)] = (int((cdf < q).sum()) + 1) / self.num_bins
+        stats['iou_nan'] = int(self.nan_count.item())
+        return stats
+
+    def state_dict(self):
+        return {
+            'num_bins': self.num_bins,
+            'hist': None if self.hist is None else self.hist.cpu(),
+            'total': None if self.total is None else self.total.item(),
+            'nan_count': None if self.nan_count is None else int(self.nan_count.item()),
+        }
+
+    def load_state_dict(self, state):
+        self.num_bins = state['num_bins']
+        if state['hist'] is None:
+            self.reset()
+            return
+        self.hist = state['hist'].to(torch.float64)
+        self.total = torch.tensor(state['total'], dtype=torch.float64)
+        self.nan_count = torch.tensor(state['nan_count'], dtype=torch.float64)
+
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)
@@ -158,13 +251,16 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self._deferred = []
+        self._deferred_keys = None
 
-    def update(self, **kwargs):
+    def update(self, n=1, **kwargs):
+        """ n: number of samples the values are averaged over, their weight in global_avg """
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
                 v = v.item()
             assert isinstance(v, (float, int))
-            self.meters[k].update(v)
+            self.meters[k].update(v, n=n)
 
     def __getattr__(self, attr):
         if attr in self.meters:
@@ -177,14 +273,70 @@ class MetricLogger(object):
     def __str__(self):
         loss_str = []
         for name, meter in self.meters.items():
+            if not meter.deque:
+                # only reduced from the other processes, see synchronize_between_processes
+                continue
             loss_str.append(
                 "{}: {}".format(name, str(meter))
             )
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """
+        Reduces the count and total of every meter, see SmoothedValue.synchronize_between_processes.
+        A process may not have updated every meter, e.g. with an empty evaluation shard, so
+        the union of the meter names is reduced, in the same order on every process.
+        """
+        if not is_dist_avail_and_initialized():
+            return
+        names = sorted(set().union(*all_gather(sorted(self.meters))))
+        meters = [self.meters[name] for name in names]
+        t = torch.tensor([[m.count, m.total] for m in meters], dtype=torch.float64, device='cuda')
+        dist.all_reduce(t.view(-1))
+        for meter, (count, total) in zip(meters, t.tolist()):
+            meter.count = int(count)
+            meter.total = total
+
+    def update_deferred(self, **kwargs):
+        """ Like update, for device tensors that are kept on the device until flush_deferred """
+        if self._deferred_keys is None:
+            self._deferred_keys = list(kwargs.keys())
+        assert list(kwargs.keys()) == self._deferred_keys
+        device = next((v.device for v in kwargs.values() if isinstance(v, torch.Tensor)), None)
+        self._deferred.append(torch.stack([torch.as_tensor(kwargs[k], device=device).detach().float().reshape(())
+                                           for k in self._deferred_keys]))
+
+    def flush_deferred(self, reduce=True):
+        """ Averages the deferred values of every step over the processes with a single
+        all_reduce and a single host copy, then updates the meters step by step, as update
+        would have. Returns the list of the per step values as dicts.
+        """
+        if not self._deferred:
+            return []
+        values = torch.stack(self._deferred)  # steps x keys
+        world_size = get_world_size()
+        if reduce and world_size > 1:
+            dist.all_reduce(values)
+            values /= world_size
+        rows = [dict(zip(self._deferred_keys, row)) for row in values.tolist()]
+        self._deferred = []
+        for row in rows:
+            for k, v in row.items():
+                self.meters[k].update(v)
+        return rows
+
+    def state_dict(self):
+        return {name: {'window_size': meter.deque.maxlen, 'fmt': meter.fmt, 'deque': list(meter.deque),
+                       'count': meter.count, 'total': meter.total}
+                for name, meter in self.meters.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, state in state_dict.items():
+            meter = SmoothedValue(window_size=state['window_size'], fmt=state['fmt'])
+            meter.deque.extend(state['deque'])
+            meter.count = state['count']
+            meter.total = state['total']
+            self.meters[name] = meter
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
@@ -284,17 +436,22 @@ class NestedTensor(object):
         self.tensors = tensors
         self.mask = mask
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        # called by the DataLoader with pin_memory=True
+        mask = self.mask.pin_memory() if self.mask is not None else None
+        return NestedTensor(self.tensors.pin_memory(), mask)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -423,6 +580,26 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def get_rng_state():
+    """ States of the torch, cuda, numpy and random generators of this process """
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -518,3 +695,18 @@ def IoU_values(anchors, targets):
         ancs[:, 3], tgts[:, 2] * tgts[:, 3]
     union = anc_sz.unsqueeze(1) + tgt_sz.unsqueeze(0) - inter
     return inter/(union+1e-8)
+
+def paired_IoU_values(anchors, targets):
+    """
+    Compute the IoU of each of `anchors` with the target in the same row,
+    the diagonal of `IoU_values` without the pairwise matrix.
+    Expects both in tlbr format
+    """
+    top_left_i = torch.max(anchors[:, :2], targets[:, :2])
+    bot_right_i = torch.min(anchors[:, 2:], targets[:, 2:])
+    sizes = torch.clamp(bot_right_i - top_left_i, min=0)
+    inter = sizes[:, 0] * sizes[:, 1]
+    ancs, tgts = tlbr2cthw(anchors), tlbr2cthw(targets)
+    anc_sz, tgt_sz = ancs[:, 2] * ancs[:, 3], tgts[:, 2] * tgts[:, 3]
+    union = anc_sz + tgt_sz - inter
+    return inter/(union+1e-8)
@@ -0,0 +1,70 @@
+"""
+Background writer of the per-sample evaluation predictions.
+"""
+import json
+import os
+import queue
+import shutil
+import threading
+
+import torch
+import torch.distributed as dist
+
+from util.misc import get_rank, get_world_size, is_dist_avail_and_initialized, is_main_process
+
+
+class PredictionWriter(object):
+    """
+    Streams the matched predictions of each evaluation batch to a JSONL file, one line
+    per (sample, word): idx, image_id, token, tgt_token, box (x0, y0, x1, y1 in pixels),
+    iou and score.
+
+    The batches are handed to a writer thread with their tensors still on the device,
+    the thread waits for them and does the host copy and the serialization, so the
+    evaluation loop does not synchronize. The queue is bounded, so the memory does not
+    grow with the split size when the disk is slower than the evaluation.
+    Each rank writes its own part file, merged into filename by close().
+    """
+
+    def __init__(self, filename, max_pending=64):
+        self.filename = filename
+        self.part_filename = '{}.part{}'.format(filename, get_rank())
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, preds):
+        """ preds: dict of tensors with one row per prediction, see SetCriterion.matched_predictions """
+        preds = {k: v.detach() for k, v in preds.items()}
+        event = None
+        if torch.cuda.is_available() and any(v.is_cuda for v in preds.values()):
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((preds, event))
+
+    def _run(self):
+        with open(self.part_filename, 'w') as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                preds, event = item
+                if event is not None:
+                    event.synchronize()
+                preds = {k: v.cpu().tolist() for k, v in preds.items()}
+                for i in range(len(preds['idx'])):
+                    f.write(json.dumps({k: v[i] for k, v in preds.items()}) + '\n')
+
+    def close(self):
+        """ Flushes the pending batches, then merges the part files of all ranks on the main process """
+        self.queue.put(None)
+        self.thread.join()
+        if is_dist_avail_and_initialized():
+            dist.barrier()
+        if is_main_process():
+            with open(self.filename, 'w') as out:
+                for rank in range(get_world_size()):
+                    part_filename = '{}.part{}'.format(self.filename, rank)
+                    with open(part_filename, 'r') as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(part_filename)
@@ -0,0 +1,143 @@
+"""
+Overlaps the host to device copies of the batches with the training / evaluation steps.
+"""
+import queue
+import threading
+import time
+
+import torch
+
+from util.misc import NestedTensor
+
+# batch entries that stay on the host, e.g. raw sentences for the tokenizer
+HOST_KEYS = ('sents', 'masked_words')
+
+
+def batch_to(batch, device, non_blocking=False):
+    return {k: v.to(device, non_blocking=non_blocking) if k not in HOST_KEYS else v for k, v in batch.items()}
+
+
+def _record_stream(batch, stream):
+    # the copies were allocated on the side stream, they are used by the current one
+    for k, v in batch.items():
+        if k in HOST_KEYS:
+            continue
+        tensors = [v.tensors, v.mask] if isinstance(v, NestedTensor) else [v]
+        for t in tensors:
+            if isinstance(t, torch.Tensor) and t.is_cuda:
+                t.record_stream(stream)
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates over a loader of batch dicts, with the entries except HOST_KEYS already
+    on device. The next batch is copied while the current one is used: on a side
+    stream for CUDA devices (non_blocking, the loader should pin its memory), by a
+    background thread otherwise.
+    copy_time: seconds spent in the copies so far.
+    hidden_time: the part of copy_time the consumer did not wait for, i.e. the copy
+    time minus, per batch, how long the consumer was blocked on that copy.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.copy_time = 0.
+        self.hidden_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _account(self, copy_time, wait_time):
+        self.copy_time += copy_time
+        self.hidden_time += copy_time - min(copy_time, max(wait_time, 0.))
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        # start and end events of the copies, and when the consuming stream reached them,
+        # per batch, not accounted yet
+        pending = []
+
+        def _preload(it):
+            batch = next(it, None)
+            if batch is None:
+                return None, None
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            with torch.cuda.stream(stream):
+                start.record(stream)
+                batch = batch_to(batch, self.device, non_blocking=True)
+                end.record(stream)
+            return batch, (start, end)
+
+        def _account_done(wait_all=False):
+            # ready can complete before the copy when the consuming stream is idle,
+            # the timings are only valid once the end of the copy completed
+            while pending and (wait_all or (pending[0][1].query() and pending[0][2].query())):
+                start, end, ready = pending.pop(0)
+                end.synchronize()
+                ready.synchronize()
+                # the consuming stream stalled from ready until the end of the copy
+                self._account(start.elapsed_time(end) / 1000, ready.elapsed_time(end) / 1000)
+
+        it = iter(self.loader)
+        batch, events = _preload(it)
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            ready = torch.cuda.Event(enable_timing=True)
+            ready.record(current)
+            current.wait_stream(stream)
+            _record_stream(batch, current)
+            pending.append(events + (ready,))
+            next_batch, next_events = _preload(it)
+            _account_done()
+            yield batch
+            batch, events = next_batch, next_events
+        _account_done(wait_all=True)
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _run():
+            try:
+                for batch in self.loader:
+                    start = time.time()
+                    batch = batch_to(batch, self.device)
+                    _put((batch, time.time() - start))
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                # raised again in the iterating thread
+                _put(e)
+            _put(None)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = batches.get()
+                wait_time = time.time() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, copy_time = item
+                # the wait also covers the loading, at most the copy time of it is exposed
+                self._account(copy_time, wait_time)
+                yield batch
+        finally:
+            stop.set()
@@ -5,90 +5,185 @@ import matplotlib.pylab as plt
 import numpy as np
 import seaborn as sns
 import os
+import queue
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import ast
 from PIL import Image, ImageDraw, ImageFont
+import torch
 import tqdm
 
-def save_visualize(outputs, visualize_dir):
+IMG_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMG_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class AttentionDumper(object):
     """
-    Save self-attention and cross-modal attention weights to files along with
-    imgs and word queries
+    Save self-attention and cross-modal attention weights along with imgs and
+    word queries, one compressed {idx}.npz file per sample:
+        sent: the sentence
+        size: [h, w] of the feature map
+        img: the unpadded image, h x w x 3 uint8
+        self_att: L x N x N, cross_att: L x N x (h*w), fp16
+        query_id: the word with the highest object score
+
+    Only the samples in ids, or else a deterministic sample_rate fraction of them,
+    are kept. The device to host copies and the writes run in a background
+    thread, the queue is bounded so the memory stays flat.
 
-    outputs: model outputs dict
     visualize_dir: path to save files
     """
-    if len(outputs['ids']) == 0:
-        return
-    filename = osp.join(visualize_dir, str(outputs['ids'][0])+'.json')
-    query_ids = outputs['pred_logits'][:,:,0]
-    _, query_ids = query_ids.max(1)    
-    att_dict = {
-        'sents': outputs['sents'],
-        'size': outputs['size'],
-        'img': outputs['img'],
-        'self_att': outputs['self_att'],
-        'cross_att': outputs['cross_att'],
-        'query_ids': query_ids.cpu().detach().tolist(),
-    }
-    with open(filename, 'w') as f:
-        json.dump(att_dict, f)
-
-
-def show(filename, split_sent=9):
+
+    def __init__(self, visualize_dir, sample_rate=1.0, ids=None, max_pending=16):
+        self.visualize_dir = visualize_dir
+        self.sample_rate = sample_rate
+        self.ids = set(ids) if ids is not None else None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def select(self, idxs):
+        """ Batch positions of the samples to dump, idxs: list of sample idx """
+        if self.ids is not None:
+            return [i for i, idx in enumerate(idxs) if idx in self.ids]
+        return [i for i, idx in enumerate(idxs) if random.Random(idx).random() < self.sample_rate]
+
+    def put(self, outputs, targets, keep, idxs):
+        """ Queues the samples at batch positions keep, the outputs of a visualize forward """
+        if len(keep) == 0:
+            return
+        pos = torch.as_tensor(keep, device=outputs['pred_logits'].device)
+        imgs = targets['img'].decompose()[0]
+        item = {
+            'idxs': [idxs[i] for i in keep],
+            'sents': [targets['sents'][i] for i in keep],
+            'size': outputs['size'],
+            'img_size': targets['size'].index_select(0, pos),
+            'img': imgs.index_select(0, pos).detach(),
+            'self_att': outputs['self_att'].index_select(0, pos).half(),
+            'cross_att': outputs['cross_att'].index_select(0, pos).half(),
+            'query_id': outputs['pred_logits'][:, :, 0].index_select(0, pos).argmax(1),
+        }
+        event = None
+        if item['img'].is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((item, event))
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            item, event = batch
+            if event is not None:
+                event.synchronize()
+            img_sizes = item['img_size'].cpu().tolist()
+            imgs = item['img'].cpu().numpy()
+            self_att = item['self_att'].cpu().numpy()
+            cross_att = item['cross_att'].cpu().numpy()
+            query_ids = item['query_id'].cpu().tolist()
+            for i, idx in enumerate(item['idxs']):
+                h, w = img_sizes[i]
+                img = imgs[i, :, :h, :w].transpose((1, 2, 0)) * IMG_STD + IMG_MEAN
+                np.savez_compressed(
+                    osp.join(self.visualize_dir, '{}.npz'.format(idx)),
+                    sent=np.array(item['sents'][i]),
+                    size=np.array(item['size']),
+                    img=(img.clip(0, 1) * 255).astype(np.uint8),
+                    self_att=self_att[i],
+                    cross_att=cross_att[i],
+                    query_id=np.array(query_ids[i]),
+                )
+
+    def close(self):
+        """ Waits for the pending samples to be written """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _as_list(x):
+    # fire gives a single int or a tuple for the layers/words arguments
+    if x is None:
+        return None
+    return [x] if isinstance(x, int) else list(x)
+
+
+def show(filename, split_sent=9, layers=None, words=None, out_dir=None, overwrite=True):
     """
     Show self-attention and cross-attention
     Parameters:
-        filename: filename of attention maps
-        split_sent: the number of first N words to show
+        filename: filename of attention maps, see AttentionDumper
+        split_sent: the number of first N words to show, when words is not given
+        layers: decoder layers to show, all by default
+        words: word indices to show
+        out_dir: directory of the figures, the directory of filename by default
+        overwrite: when False, samples whose figures exist are skipped
     """
-    with open(filename, 'r') as f:
-        data = json.load(f)
-    file_prefix = filename.split(".")[0]
+    file_prefix = osp.splitext(filename)[0]
+    if out_dir is not None:
+        file_prefix = osp.join(out_dir, osp.basename(file_prefix))
+    cross_file = file_prefix + "_crossattn.png"
+    img_file = file_prefix + "_img.png"
+    if not overwrite and osp.exists(cross_file) and osp.exists(img_file):
+        return False
+    # the arrays are only read from the file when accessed
+    data = np.load(filename)
     # get sentence words
-    sents = [s.split() for s in data['sents']]
-    self_att = np.array(data['self_att'])  # B x L x N x N
-    cross_att = np.array(data['cross_att'])  # B x L x N x (H*W)
-    b, l, n, _ = cross_att.shape
-    # better visualization with seaborn
-    cross_att = cross_att.reshape((b, l, n, 20, 20))
-    subject = [(i,s[i] if i<len(s) else "PD") for s, i in zip(sents, data['query_ids'])]
-    imgs = np.array(data['img']).transpose((0, 2, 3, 1))
-
-    # self-attention visualization
-#    for i in range(b):
-#        title = "Idx: " + str(subject[i][0]) + "; Target: "+ subject[i][1] + "; " + data['sents'][i]
-#        fig, axes = plt.subplots(nrows=2, ncols=3, figsize=[25, 15])
-#        fig.suptitle(title, fontsize=30)
-#        for j in range(l):
-#            sns.heatmap(self_att[i][j][:split_sent, :split_sent], ax=axes[int(j/3)][j%3], 
-#                        annot=self_att[i][j][:split_sent, :split_sent],cmap='YlGn')
-#            axes[int(j/3)][j%3].set_title("Level " + str(j))
-#        fig.savefig(file_prefix+"_selfattn_"+str(i)+".png")
-#        plt.close(fig)
+    sent = str(data['sent'])
+    words_list = sent.split()
+    cross_att = data['cross_att']  # L x N x (H*W)
+    l, n, _ = cross_att.shape
+    layers = _as_list(layers) or list(range(l))
+    words = _as_list(words) or list(range(min(split_sent, n)))
+    words = [k for k in words if k < n]
+    # better visualization with seaborn, with the feature map size stored in the dump
+    h, w = data['size']
+    query_id = int(data['query_id'])
+    subject = (query_id, words_list[query_id] if query_id < len(words_list) else "PD")
+    title = "Idx: " + str(subject[0]) + "; Target: " + subject[1] + "; " + sent
 
     # cross-attention visualization
-    for i in range(b):
-        title = "Idx: " + str(subject[i][0]) + "; Target: "+ subject[i][1] + "; " + data['sents'][i]
-        fig, axes = plt.subplots(nrows=6, ncols=split_sent, figsize=[30, 18])
-        fig.suptitle(title, fontsize=30)
-        for j in range(l):
-            for k in range(split_sent):
-                sns.heatmap(cross_att[i][j][k], ax=axes[j][k], cmap='YlGn')
-                word = sents[i][k] if k < len(sents[i]) else "PD"
-                axes[j][k].set_title("Level {}:".format(j)+"; "+word)
-        fig.savefig(file_prefix+"_crossattn_"+str(i)+".png")
-        plt.close(fig)
+    fig, axes = plt.subplots(nrows=len(layers), ncols=len(words),
+                             figsize=[30 * len(words) / 9, 3 * len(layers)], squeeze=False)
+    fig.suptitle(title, fontsize=30)
+    for j, layer in enumerate(layers):
+        for c, k in enumerate(words):
+            sns.heatmap(cross_att[layer][k].astype(np.float32).reshape(h, w), ax=axes[j][c], cmap='YlGn')
+            word = words_list[k] if k < len(words_list) else "PD"
+            axes[j][c].set_title("Level {}:".format(layer)+"; "+word)
+    fig.savefig(cross_file)
+    plt.close(fig)
 
     # images visualization
-    for i in range(b):
-        title = "Idx: " + str(subject[i][0]) + "; Target: "+ subject[i][1] + "; " + data['sents'][i]
-        fig = plt.figure(i)
-        fig.suptitle(title, fontsize=20)
-        plt.imshow(imgs[i])
-        fig.savefig(file_prefix+"_img_"+str(i)+".png")
-        plt.close(fig)
-    print("Complete show " + filename)
+    fig = plt.figure()
+    fig.suptitle(title, fontsize=20)
+    plt.imshow(data['img'])
+    fig.savefig(img_file)
+    plt.close(fig)
+    return True
+
+
+def _show_worker(kwargs):
+    return show(**kwargs)
+
+
+def render(visualize_dir, out_dir=None, layers=None, words=None, split_sent=9,
+           num_workers=None, overwrite=False):
+    """
+    Render the figures of every attention dump of visualize_dir with a process pool,
+    see show for the parameters. Samples already rendered are skipped unless overwrite.
+    """
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    files = sorted(osp.join(visualize_dir, f) for f in os.listdir(visualize_dir) if f.endswith('.npz'))
+    jobs = [dict(filename=f, split_sent=split_sent, layers=layers, words=words,
+                 out_dir=out_dir, overwrite=overwrite) for f in files]
+    with ProcessPoolExecutor(num_workers) as pool:
+        rendered = sum(tqdm.tqdm(pool.map(_show_worker, jobs, chunksize=16), total=len(jobs)))
+    print("Rendered {} of {} samples".format(rendered, len(jobs)))
 
 
 def read_annotations(ds_name, trn_file):
@@ -124,7 +219,28 @@ def read_annotations(ds_name, trn_file):
             raise RuntimeError("No dataset named {}".format(ds_name))
         return trn_df
 
-def visual_dataset(ds_name, ds_dict):
+def _draw_boxes(job):
+    img_file, vis_file, boxes = job
+    img = Image.open(img_file)
+    img = img.convert("RGB")
+    new_img = ImageDraw.Draw(img)
+    font = ImageFont.truetype(font='./data/times.ttf', size=20)
+    for k, (x1, y1, x2, y2, query) in enumerate(boxes):
+        x1 = int(x1)
+        x2 = int(x2)
+        y1 = int(y1)
+        y2 = int(y2)
+        new_img.rectangle(((x1, y1), (x2, y2)), outline=(0, 255, 0), width=3)
+        # one line per query of the image
+        new_img.text((0, 22 * k), str(query), (255, 0, 255), font=font)
+    img.save(vis_file)
+
+
+def visual_dataset(ds_name, ds_dict, num_workers=None, overwrite=False):
+    """ Draws the ground truth boxes and queries of every val/test image, with a process pool.
+    The rows of an image are drawn by the same job, into one file per image.
+    Images already drawn are skipped unless overwrite.
+    """
     img_path = ds_dict[ds_name]['img_dir']
     for data_type in ds_dict[ds_name].keys():
         if data_type.startswith("val") or data_type.startswith("test"):
@@ -133,27 +249,34 @@ def visual_dataset(ds_name, ds_dict):
             suffix = osp.basename(gt_file).split(".")[0]
             vis_img_path = osp.join(ds_dict[ds_name]['data_dir'], "vis_" +suffix)
             os.makedirs(vis_img_path, exist_ok=True)
-            for idx in tqdm.tqdm(range(len(gt_data))):
-                img_file, x1, y1, x2, y2, query = gt_data.iloc[idx]
-                img = Image.open(osp.join(img_path, img_file))
-                img = img.convert("RGB")
-                new_img = ImageDraw.Draw(img)
-                x1 = int(x1)
-                x2 = int(x2)
-                y1 = int(y1)
-                y2 = int(y2)
-                new_img.rectangle(((x1, y1), (x2, y2)), outline=(0, 255, 0), width=3)
-                new_img.text((0, 0), query, (255, 0, 255), font=ImageFont.truetype(font='./data/times.ttf', size=20))
-                img.save(osp.join(vis_img_path, osp.basename(img_file)))
-
-
-def visual_all_dataset():
-    ds_lists = ['refcoco', 'refcoco+', 'refcocog', 'refclef', 'flickr30k']
+            # several referring expressions share an image, a job per row would have
+            # several workers writing the same file
+            boxes = {}
+            for img_file, x1, y1, x2, y2, query in gt_data.itertuples(index=False, name=None):
+                boxes.setdefault(str(img_file), []).append((x1, y1, x2, y2, query))
+            jobs = []
+            for img_file, img_boxes in boxes.items():
+                vis_file = osp.join(vis_img_path, osp.basename(img_file))
+                if not overwrite and osp.exists(vis_file):
+                    continue
+                jobs.append((osp.join(img_path, img_file), vis_file, img_boxes))
+            with ProcessPoolExecutor(num_workers) as pool:
+                list(tqdm.tqdm(pool.map(_draw_boxes, jobs, chunksize=64), total=len(jobs)))
+
+
+def visual_all_dataset(ds_lists=('refcoco', 'refcoco+', 'refcocog', 'refclef', 'flickr30k'),
+                       num_workers=None, overwrite=False):
     with open("./data/ds_info.json", 'r') as f:
         ds_dict = json.load(f)
+    if isinstance(ds_lists, str):
+        ds_lists = [ds_lists]
     for ds_name in ds_lists:
         print("Dataset: " + ds_name)
-        visual_dataset(ds_name, ds_dict)
+        visual_dataset(ds_name, ds_dict, num_workers, overwrite)
 
 if __name__ == "__main__":
-    visual_all_dataset()
+    fire.Fire({
+        'show': show,
+        'render': render,
+        'dataset': visual_all_dataset,
+    })